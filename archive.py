@@ -0,0 +1,226 @@
+import os
+import sys
+import gzip
+import json
+import time
+import tarfile
+import logging
+import argparse
+import tempfile
+from typing import BinaryIO, Dict, Iterator, List, Set, Text, Tuple
+from dotenv import load_dotenv
+import bowtiedb
+import storage
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+load_dotenv()
+
+# One json object per line, the first line identifies the format
+ARCHIVE_FORMAT = "bowtie-archive"
+ARCHIVE_VERSION = 1
+BATCH_SIZE = 500
+# Names inside a media bundle
+BUNDLE_ARCHIVE = "bowtie.jsonl"
+BUNDLE_DOWNLOADS = "downloads/"
+
+def entryRecord(entry: bowtiedb.Entry) -> Dict:
+    record = json.loads(entry.to_json())
+    record["id"] = record.pop("identity")
+    record["type"] = "entry"
+    return record
+
+def iterRecords(media: Set[Text]) -> Iterator[Dict]:
+    # Keyset over each table's primary key, one batch in memory at a time.
+    # Names of downloads used by exported entries are collected into media.
+    yield {"type": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION, "time": int(time.time())}
+    identity = 0
+    while True:
+        entries = bowtiedb.find_entries_after_id(identity, BATCH_SIZE)
+        for entry in entries:
+            if entry.photo:
+                media.add(entry.photo)
+            if entry.icon:
+                media.add(entry.icon)
+            yield entryRecord(entry)
+        if len(entries) < BATCH_SIZE:
+            break
+        identity = entries[-1].identity
+    identity = 0
+    while True:
+        assets = bowtiedb.find_assets_after_id(identity, BATCH_SIZE)
+        for asset in assets:
+            yield {"type": "asset", "source": asset.source, "variant": asset.variant, "destination": asset.destination}
+        if len(assets) < BATCH_SIZE:
+            break
+        identity = assets[-1].identity
+    identity = 0
+    while True:
+        tweets = bowtiedb.find_tweets_after_id(identity, BATCH_SIZE)
+        for (tweet_id, tweet_json) in tweets:
+            yield {"type": "tweet", "id": tweet_id, "json": json.loads(tweet_json)}
+        if len(tweets) < BATCH_SIZE:
+            break
+        identity = tweets[-1][0]
+
+def writeRecords(fh: BinaryIO, media: Set[Text]) -> int:
+    count = 0
+    for record in iterRecords(media):
+        fh.write(json.dumps(record).encode("utf-8") + b"\n")
+        count += 1
+    return count - 1
+
+def export(fh: BinaryIO, bundle_media: bool = False, compress: bool = False) -> int:
+    media: Set[Text] = set()
+    if not bundle_media:
+        if compress:
+            with gzip.GzipFile(fileobj=fh, mode='wb') as gz:
+                return writeRecords(gz, media)
+        return writeRecords(fh, media)
+    # A tar member needs its size up front, so the records are spooled first
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as records:
+        count = writeRecords(records, media)
+        with tarfile.open(fileobj=fh, mode="w|gz" if compress else "w|") as tar:
+            info = tarfile.TarInfo(BUNDLE_ARCHIVE)
+            info.size = records.tell()
+            info.mtime = int(time.time())
+            records.seek(0)
+            tar.addfile(info, records)
+            for name in sorted(media):
+                path = storage.downloadPath(name)
+                if os.path.exists(path):
+                    tar.add(path, arcname=BUNDLE_DOWNLOADS + name, recursive=False)
+                else:
+                    logging.warning("Missing download %s, not bundled", name)
+    return count
+
+@bowtiedb.with_connection
+def importBatch(entries: List[bowtiedb.Entry], assets: List[bowtiedb.Asset], tweets: List, taken: List[bowtiedb.Entry]) -> int:
+    # One transaction per batch, returns the number of records written.
+    # Entries whose id is used by a different entry are added to taken.
+    written = 0
+    if entries:
+        (count, batch_taken) = bowtiedb.import_entries(entries)
+        written += count
+        taken.extend(batch_taken)
+    if assets:
+        written += bowtiedb.add_assets(assets)
+    if tweets:
+        written += bowtiedb.import_tweets(tweets)
+    return written
+
+@bowtiedb.with_connection
+def renumberBatch(entries: List[bowtiedb.Entry]) -> None:
+    bowtiedb.add_entries(entries)
+
+def renumberEntries(taken: List[bowtiedb.Entry]) -> None:
+    # Added after every archived id has been placed, so a new id never
+    # takes the id of an entry that is still to come
+    for start in range(0, len(taken), BATCH_SIZE):
+        renumberBatch(taken[start:start + BATCH_SIZE])
+    if taken:
+        logging.info("Gave %d entries a new id, theirs belonged to a different entry", len(taken))
+
+def importRecords(lines: Iterator[bytes]) -> Tuple[int, int]:
+    # Returns the number of records written and the number skipped because
+    # the database already had them
+    entries = []
+    assets = []
+    tweets = []
+    taken = []
+    count = 0
+    written = 0
+    header = None
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if header is None:
+            header = record
+            if header.get("type") != ARCHIVE_FORMAT or header.get("version") != ARCHIVE_VERSION:
+                raise ValueError("Not a version " + str(ARCHIVE_VERSION) + " bowtie archive")
+            continue
+        kind = record.get("type")
+        if kind == "entry":
+            entries.append(bowtiedb.Entry(record["date"], record.get("content"), record.get("photo"),
+                bowtiedb.entities_from_list(record.get("entities") or []), record.get("display_name"), record.get("icon"), record["id"]))
+        elif kind == "asset":
+            assets.append(bowtiedb.Asset(record["source"], record["variant"], record["destination"]))
+        elif kind == "tweet":
+            tweets.append((record["id"], json.dumps(record["json"])))
+        else:
+            logging.warning("Skipping unknown record type %s", kind)
+            continue
+        count += 1
+        if len(entries) + len(assets) + len(tweets) >= BATCH_SIZE:
+            written += importBatch(entries, assets, tweets, taken)
+            entries = []
+            assets = []
+            tweets = []
+    if entries or assets or tweets:
+        written += importBatch(entries, assets, tweets, taken)
+    if header is None:
+        raise ValueError("Empty archive")
+    renumberEntries(taken)
+    written += len(taken)
+    return (written, count - written)
+
+def importBundle(fh: BinaryIO) -> Tuple[int, int]:
+    count = (0, 0)
+    with tarfile.open(fileobj=fh, mode="r|*") as tar:
+        for member in tar:
+            if member.name == BUNDLE_ARCHIVE:
+                count = importRecords(tar.extractfile(member))
+            elif member.isfile() and member.name.startswith(BUNDLE_DOWNLOADS):
+                # Only the base name is trusted, never a path from the bundle
+                name = os.path.basename(member.name)
+                path = storage.downloadPath(name)
+                if name and not os.path.exists(path):
+                    storage.ensureDirectory(path)
+                    with open(path + ".tmp", 'wb') as out:
+                        source = tar.extractfile(member)
+                        for chunk in iter(lambda: source.read(65536), b""):
+                            out.write(chunk)
+                    os.replace(path + ".tmp", path)
+    return count
+
+def importFile(path: Text) -> Tuple[int, int]:
+    with open(path, 'rb') as fh:
+        magic = fh.read(2)
+        fh.seek(0)
+        if tarfile.is_tarfile(path):
+            return importBundle(fh)
+        if magic == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=fh, mode='rb') as gz:
+                return importRecords(gz)
+        return importRecords(fh)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export or import entries, assets and tweets as json lines")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("--output", help="write here instead of stdout, gzip compressed when it ends with .gz")
+    export_parser.add_argument("--media", action="store_true", help="bundle the archive and the downloads it refers to in a tar file")
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("path", help="json lines, gzip compressed json lines or a media bundle")
+    args = parser.parse_args()
+    bowtiedb.init()
+    if args.command == "export":
+        compress = bool(args.output) and (args.output.endswith(".gz") or args.output.endswith(".tgz"))
+        start = time.perf_counter()
+        if args.output:
+            with open(args.output + ".tmp", 'wb') as fh:
+                count = export(fh, args.media, compress)
+            os.replace(args.output + ".tmp", args.output)
+        else:
+            count = export(sys.stdout.buffer, args.media, compress)
+        logging.info("Exported %d records in %.1fs", count, time.perf_counter() - start)
+    else:
+        start = time.perf_counter()
+        (written, skipped) = importFile(args.path)
+        logging.info("Imported %d records in %.1fs, skipped %d already present", written, time.perf_counter() - start, skipped)
+
+if __name__ == '__main__':
+    main()
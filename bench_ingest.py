@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Text, Tuple
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# Replays synthetic telegram updates and tweets through the real handlers
+# and the real generator, against local fakes of the Bot API and twitter's
+# media host, and reports how long an entry takes to reach a written page.
+BOT_TOKEN = "123:benchmarkbenchmarkbenchmarkbench"
+ADMIN = 4242
+KINDS = ["text", "photo", "sticker", "animation", "tweet"]
+# 1x1 gif, decoders stop at the trailer so bytes appended after it make
+# every download unique without making it unreadable
+PIXEL = (b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00"
+         b",\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;")
+PUBLISH_TIMEOUT = 300
+TWITTER_USER = {"id": 7, "id_str": "7", "screen_name": "bench",
+    "profile_image_url": "http://pbs.twimg.com/profile_images/7/bench_normal.jpg"}
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    server: "FakeUpstream"
+
+    def do_GET(self) -> None:
+        # The twitter API, files from the Bot API and media from pbs.twimg.com
+        url = urllib.parse.urlsplit(self.path)
+        headers: Dict[Text, Text] = {}
+        if url.path.startswith("/1.1/"):
+            (status, headers, body) = self.server.twitter(url.path, dict(urllib.parse.parse_qsl(url.query)))
+        else:
+            body = self.server.media(url.path)
+            status = 200
+            if body is None:
+                (status, body) = (404, b"")
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", "0"))
+        data = self.rfile.read(length)
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(data or b"{}")
+        else:
+            params = dict(urllib.parse.parse_qsl(data.decode()))
+        method = urllib.parse.urlsplit(self.path).path.rsplit("/", 1)[-1]
+        body = json.dumps({"ok": True, "result": self.server.call(method, params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, animation: Optional[bytes], timeline: Optional[List[Dict]] = None):
+        super().__init__(("127.0.0.1", 0), FakeUpstreamHandler)
+        self.animation = animation
+        # Statuses served by user_timeline, newest first
+        self.timeline = timeline or []
+        # Responses to give instead of a page, by timeline request number
+        # starting at 1, as (status, headers)
+        self.timeline_failures: Dict[int, Tuple[int, Dict[Text, Text]]] = {}
+        # Parameters and arrival time of every timeline request
+        self.timeline_requests: List[Tuple[Dict[Text, Text], float]] = []
+        self.lock = threading.Lock()
+
+    def url(self) -> Text:
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def call(self, method: Text, params: Dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getUserProfilePhotos":
+            user_id = str(params.get("user_id"))
+            return {"total_count": 1, "photos": [[{"file_id": "icon" + user_id, "file_unique_id": "icon" + user_id,
+                "width": 1, "height": 1, "file_size": len(PIXEL)}]]}
+        if method == "getFile":
+            file_id = str(params.get("file_id"))
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(PIXEL), "file_path": "files/" + file_id}
+        return True
+
+    def twitter(self, path: Text, params: Dict[Text, Text]) -> Tuple[int, Dict[Text, Text], bytes]:
+        headers = {"Content-Type": "application/json"}
+        if path == "/1.1/account/verify_credentials.json":
+            return (200, headers, json.dumps(TWITTER_USER).encode())
+        if path != "/1.1/statuses/user_timeline.json":
+            return (404, headers, json.dumps({"errors": [{"code": 34, "message": "Sorry, that page does not exist."}]}).encode())
+        with self.lock:
+            self.timeline_requests.append((params, time.monotonic()))
+            number = len(self.timeline_requests)
+        if number in self.timeline_failures:
+            (status, failure_headers) = self.timeline_failures[number]
+            return (status, dict(headers, **failure_headers), json.dumps({"errors": [{"code": 0, "message": "Failure " + str(status)}]}).encode())
+        max_id = int(params["max_id"]) if "max_id" in params else None
+        page = [status for status in self.timeline if max_id is None or status["id"] <= max_id]
+        return (200, headers, json.dumps(page[:int(params.get("count", "20"))]).encode())
+
+    def media(self, path: Text) -> Optional[bytes]:
+        name = path.rsplit("/", 1)[-1]
+        if name.startswith("missing"):
+            # Deleted or withheld media
+            return None
+        if name.startswith("anim") and self.animation:
+            return self.animation + name.encode()
+        return PIXEL + name.encode()
+
+def setupEnvironment(workdir: Text, upstream: FakeUpstream) -> None:
+    # Every module reads its configuration when imported, so this has to
+    # happen before the first import and always points at scratch paths
+    os.environ["DB"] = os.path.join(workdir, "bench.sqlite")
+    os.environ["DOWNLOADS_PATH"] = os.path.join(workdir, "downloads")
+    os.environ["WEB_PATH"] = os.path.join(workdir, "web")
+    os.environ["BOT_TOKEN"] = BOT_TOKEN
+    os.environ["ADMIN"] = str(ADMIN)
+    os.environ["BOT_MODE"] = "polling"
+    os.environ["BOT_API_URL"] = upstream.url()
+    os.environ["TWITTER_API_URL"] = upstream.url()
+    os.environ["TWITTER_MEDIA_URL"] = upstream.url()
+    for name in ["TWITTER_KEY", "TWITTER_SECRET", "TWITTER_ACCESS_TOKEN", "TWITTER_ACCESS_TOKEN_SECRET"]:
+        os.environ[name] = "benchmark"
+    for name in ["SFTP_HOST", "SFTP_USER", "SFTP_PASS", "SFTP_PATH"]:
+        os.environ[name] = ""
+
+def makeAnimation(workdir: Text) -> Optional[bytes]:
+    if not shutil.which("ffmpeg"):
+        return None
+    import ffmpeg
+    path = os.path.join(workdir, "animation.mp4")
+    stream = ffmpeg.input("testsrc=size=320x240:rate=10:duration=3", f="lavfi")
+    ffmpeg.run(ffmpeg.output(stream, path, pix_fmt="yuv420p"), quiet=True, overwrite_output=True)
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+def makeMessage(kind: Text, marker: Text, sequence: int) -> Dict:
+    message = {
+        "message_id": sequence,
+        "date": int(time.time()),
+        "chat": {"id": ADMIN, "type": "private"},
+        "from": {"id": ADMIN, "is_bot": False, "first_name": "Bench"},
+    }
+    file_id = kind + str(sequence)
+    if kind == "text":
+        message["text"] = marker
+    elif kind == "photo":
+        message["caption"] = marker
+        message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1, "file_size": len(PIXEL)}]
+    elif kind == "sticker":
+        message["caption"] = marker
+        message["sticker"] = {"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1, "is_animated": False}
+    elif kind == "animation":
+        file_id = "anim" + str(sequence)
+        message["caption"] = marker
+        message["animation"] = {"file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 240,
+            "duration": 3, "file_size": 100000}
+    return {"update_id": sequence, "message": message}
+
+def makeStatus(marker: Text, sequence: int) -> Dict:
+    return {
+        "id": sequence,
+        "id_str": str(sequence),
+        "created_at": time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime()),
+        "full_text": marker,
+        "display_text_range": [0, len(marker)],
+        "entities": {},
+        "extended_entities": {"media": [{"media_url": "http://pbs.twimg.com/media/tweet" + str(sequence) + ".jpg"}]},
+        "user": TWITTER_USER,
+    }
+
+class Builder():
+    # Runs the generator whenever an entry is committed, the same way the
+    # unified runtime does, and remembers the journal position of each build
+    def __init__(self):
+        import gen
+        import bowtiedb
+        self.gen = gen
+        self.state = gen.State()
+        self.changed = threading.Event()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.builds: List[Tuple[float, int]] = []
+        bowtiedb.add_entry_listener(self.changed.set)
+        self.thread = threading.Thread(target=self.run, name="builder", daemon=True)
+
+    def start(self) -> None:
+        self.gen.setup()
+        self.build()
+        self.thread.start()
+
+    def build(self) -> None:
+        self.gen.build(self.state)
+        if self.state.seq is not None:
+            with self.lock:
+                self.builds.append((time.perf_counter(), self.state.seq))
+
+    def run(self) -> None:
+        while not self.stopped:
+            if not self.changed.wait(1):
+                continue
+            self.changed.clear()
+            try:
+                self.build()
+            except Exception as e:
+                logging.error("Build failed: %s", e)
+
+    def published(self, seq: int) -> Optional[float]:
+        # A build that reached this change has written everything before it
+        with self.lock:
+            for (finished, built) in self.builds:
+                if built >= seq:
+                    return finished
+        return None
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.changed.set()
+        self.thread.join()
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(p / 100 * len(ordered))) - 1, 0)]
+
+def runBurst(size: int, kinds: List[Text], concurrency: int, updater, builder: Builder, run_id: Text) -> Dict:
+    import bot
+    import twitter
+    import tweepy.models
+    import bowtiedb
+
+    def inject(sequence: int) -> Tuple[Text, float, int]:
+        kind = kinds[sequence % len(kinds)]
+        marker = "bench %s %d %s" % (run_id, sequence, kind)
+        start = time.perf_counter()
+        if kind == "tweet":
+            status = tweepy.models.Status.parse(twitter.api, makeStatus(marker, int(run_id) * 100000 + sequence))
+            twitter.handleTimeline([status])
+        else:
+            bot.processUpdate(updater, makeMessage(kind, marker, sequence))
+        # At or after the change that stored this entry, concurrent updates
+        # can only make the measured latency longer
+        return (marker, start, bowtiedb.latest_change())
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        injected = list(pool.map(inject, range(size)))
+
+    stored = set([entry.content for entry in bowtiedb.find_entries(limit=size * 2)])
+    missing = [marker for (marker, _, _) in injected if marker not in stored]
+    if missing:
+        raise RuntimeError("%d entries were not stored, first: %s" % (len(missing), missing[0]))
+    newest = max(seq for (_, _, seq) in injected)
+    deadline = time.perf_counter() + PUBLISH_TIMEOUT
+    while builder.published(newest) is None:
+        if time.perf_counter() > deadline:
+            raise RuntimeError("Entries were not published within %d seconds" % PUBLISH_TIMEOUT)
+        time.sleep(0.01)
+
+    latencies = [builder.published(seq) - start for (_, start, seq) in injected]
+    first = min(start for (_, start, _) in injected)
+    last = max(builder.published(seq) for (_, _, seq) in injected)
+    return {
+        "burst": size,
+        "kinds": kinds,
+        "concurrency": concurrency,
+        "time": int(time.time()),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1),
+        "entries_per_sec": round(size / (last - first), 1),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure ingest to publish latency of bursts of telegram updates and tweets")
+    parser.add_argument("--bursts", default="1,10,50", help="comma separated burst sizes")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="comma separated mix of " + ", ".join(KINDS))
+    parser.add_argument("--concurrency", type=int, default=4, help="updates handled at once, like WEBHOOK_WORKERS")
+    parser.add_argument("--workdir", help="keep the database, downloads and pages here instead of a temporary directory")
+    parser.add_argument("--output", help="append one json line per burst to this file")
+    args = parser.parse_args()
+    # The handlers print as they go, keep stdout for the report
+    report_stream = sys.stdout
+    sys.stdout = sys.stderr
+    kinds = [kind.strip() for kind in args.kinds.split(",") if kind.strip()]
+    for kind in kinds:
+        if kind not in KINDS:
+            parser.error("unknown kind " + kind)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_ingest.")
+    os.makedirs(workdir, exist_ok=True)
+    animation = makeAnimation(workdir) if "animation" in kinds else None
+    if "animation" in kinds and animation is None:
+        logging.warning("ffmpeg is not installed, leaving animations out")
+        kinds.remove("animation")
+    upstream = FakeUpstream(animation)
+    threading.Thread(target=upstream.serve_forever, name="upstream", daemon=True).start()
+    setupEnvironment(workdir, upstream)
+
+    import bowtiedb
+    import bot
+    bowtiedb.init()
+    updater = bot.createUpdater()
+    builder = Builder()
+    # The first build of a process renders everything, get it out of the way
+    bot.processUpdate(updater, makeMessage("text", "bench warmup", 0))
+    builder.start()
+    try:
+        for (index, size) in enumerate([int(size) for size in args.bursts.split(",")]):
+            run_id = str(int(time.time()) % 100000 * 100 + index)
+            report = runBurst(size, kinds, args.concurrency, updater, builder, run_id)
+            line = json.dumps(report)
+            print(line, file=report_stream)
+            if args.output:
+                with open(args.output, 'a') as fh:
+                    fh.write(line + "\n")
+    finally:
+        builder.stop()
+        upstream.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
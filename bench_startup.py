@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List, Text, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ENTRY_POINTS = ["bot", "twitter", "gen", "web"]
+# Entry points read these at import time, placeholders are enough to import
+PLACEHOLDER_ENV = {
+    "DB": ":memory:",
+    "DOWNLOADS_PATH": "/tmp",
+    "WEB_PATH": "/tmp",
+    "BOT_TOKEN": "0:placeholder",
+    "ADMIN": "0",
+    "SFTP_HOST": "",
+    "SFTP_USER": "",
+    "SFTP_PASS": "",
+    "SFTP_PATH": "",
+    "TWITTER_KEY": "placeholder",
+    "TWITTER_SECRET": "placeholder",
+    "TWITTER_ACCESS_TOKEN": "placeholder",
+    "TWITTER_ACCESS_TOKEN_SECRET": "placeholder",
+}
+# Prints peak RSS in KiB once the module is imported
+RSS_PROBE = "import resource, {module}; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+def childEnv() -> Dict[Text, Text]:
+    env = dict(os.environ)
+    for (name, value) in PLACEHOLDER_ENV.items():
+        env.setdefault(name, value)
+    return env
+
+def parseImportTime(stderr: Text) -> List[Tuple[Text, int]]:
+    # Lines look like "import time:       450 |     337693 | telegram.ext"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        # Nested imports are indented further than the single leading space
+        imports.append((parts[2][1:].rstrip(), int(parts[1])))
+    return imports
+
+def measure(module: Text, env: Dict[Text, Text]) -> Dict:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", RSS_PROBE.format(module=module)],
+        env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError("Importing " + module + " failed:\n" + result.stderr)
+    imports = parseImportTime(result.stderr)
+    # Only top level imports, nested ones are already part of their cumulative time
+    top_level = [(name, us) for (name, us) in imports if not name.startswith(" ")]
+    # Imports made directly by the entry point are indented one level
+    direct = [(name, us) for (name, us) in imports if name.startswith("  ") and not name.startswith("   ")]
+    return {
+        "wall_ms": wall * 1000,
+        "import_ms": sum([us for (_, us) in top_level]) / 1000,
+        "rss_kib": int(result.stdout.strip().splitlines()[-1]),
+        "slowest": sorted(direct, key=lambda item: -item[1])[:5],
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure cold start import time and memory of each entry point")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="append one json line per entry point to this file")
+    args = parser.parse_args()
+    env = childEnv()
+    for module in args.modules:
+        samples = [measure(module, env) for _ in range(args.runs)]
+        report = {
+            "module": module,
+            "time": int(time.time()),
+            "runs": args.runs,
+            "wall_ms": round(statistics.median([sample["wall_ms"] for sample in samples]), 1),
+            "import_ms": round(statistics.median([sample["import_ms"] for sample in samples]), 1),
+            "rss_kib": int(statistics.median([sample["rss_kib"] for sample in samples])),
+            "slowest": [[name.strip(), round(us / 1000, 1)] for (name, us) in samples[-1]["slowest"]],
+        }
+        line = json.dumps(report)
+        print(line)
+        if args.output:
+            with open(args.output, 'a') as fh:
+                fh.write(line + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,31 @@
+from __future__ import annotations
 import os
 import traceback
 import sys
 import uuid
 import time
 import json
+import hmac
+import signal
 import logging
-from typing import Dict, List, Text, Tuple, Union
-from telegram.ext import Updater, InlineQueryHandler, CommandHandler, CallbackContext, ChatMemberHandler, MessageHandler, Filters, CallbackQueryHandler
-from telegram import Update, InlineQueryResultCachedSticker, InlineKeyboardMarkup, InlineKeyboardButton
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Dict, List, Optional, Text, Tuple, Union
 from dotenv import load_dotenv
-from telegram.files.animation import Animation
-from telegram.files.photosize import PhotoSize
-from telegram.files.sticker import Sticker
-from telegram.user import User
 
 import bowtiedb
+import storage
+
+if TYPE_CHECKING:
+    # Only used for annotations, telegram.ext is imported once the bot starts
+    from telegram.ext import CallbackContext
+    from telegram import Update
+    from telegram.files.animation import Animation
+    from telegram.files.photosize import PhotoSize
+    from telegram.files.sticker import Sticker
+    from telegram.user import User
 
 class Unbuffered(object):
     def __init__(self, stream):
@@ -37,8 +48,17 @@ logging.basicConfig(level=logging.INFO,
 load_dotenv()
 
 token = os.environ["BOT_TOKEN"]
-downloads_path = os.environ["DOWNLOADS_PATH"]
 admin = int(os.getenv("ADMIN"))
+# "polling" or "webhook"
+bot_mode = os.getenv("BOT_MODE", "polling")
+webhook_url = os.getenv("WEBHOOK_URL", "")
+webhook_listen = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+webhook_port = int(os.getenv("WEBHOOK_PORT", "8443"))
+webhook_path = os.getenv("WEBHOOK_PATH", "/telegram")
+webhook_secret = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+# Point the Bot API and file downloads elsewhere, such as a local fake
+api_url = os.getenv("BOT_API_URL", "").rstrip("/")
 
 def downloadIconForUser(c: CallbackContext, user_id: int) -> Union[Text, None]:
     logging.info("Downloading icon for user %d", user_id)
@@ -60,11 +80,10 @@ def downloadIconForUser(c: CallbackContext, user_id: int) -> Union[Text, None]:
     if photo_to_use:
         logging.info("Selected file size %d: %s", size, photo_to_use)
         photo_ending = "icon_" + photo_id + ".jpg"
-        path = downloads_path + "/" + photo_ending
+        path = storage.downloadPath(photo_ending)
         if not os.path.exists(path):
             file = c.bot.get_file(photo_to_use)
-            if not os.path.exists(downloads_path):
-                os.makedirs(downloads_path)
+            storage.ensureDirectory(path)
             file.download(custom_path=path)
         return photo_ending
     return None
@@ -86,11 +105,10 @@ def downloadIconForChat(c: CallbackContext, chat_id: int) -> Union[Text, None]:
     if photo_to_use:
         logging.info("Selected file %s", photo_to_use)
         photo_ending = "icon_" + photo_id + ".jpg"
-        path = downloads_path + "/" + photo_ending
+        path = storage.downloadPath(photo_ending)
         if not os.path.exists(path):
             file = c.bot.get_file(photo_to_use)
-            if not os.path.exists(downloads_path):
-                os.makedirs(downloads_path)
+            storage.ensureDirectory(path)
             file.download(custom_path=path)
         return photo_ending
     return None
@@ -109,11 +127,10 @@ def downloadPhoto(context: CallbackContext, photos: List[PhotoSize]) -> Union[Te
                 size = photo.file_size
     if photo_to_use:
         photo_ending = "photo_" + photo_id + ".jpg"
-        path = downloads_path + "/" + photo_ending
+        path = storage.downloadPath(photo_ending)
         if not os.path.exists(path):
             file = context.bot.get_file(photo_to_use)
-            if not os.path.exists(downloads_path):
-                os.makedirs(downloads_path)
+            storage.ensureDirectory(path)
             file.download(custom_path=path)
             # TODO process photo
         return photo_ending
@@ -124,11 +141,10 @@ def downloadAnimation(context: CallbackContext, animation: Animation) -> Union[T
     file_id = animation.file_unique_id
     if file_to_use:
         file_ending = "anim_" + file_id + ".mp4"
-        path = downloads_path + "/" + file_ending
+        path = storage.downloadPath(file_ending)
         if not os.path.exists(path):
             file = context.bot.get_file(file_to_use)
-            if not os.path.exists(downloads_path):
-                os.makedirs(downloads_path)
+            storage.ensureDirectory(path)
             file.download(custom_path=path)
         return file_ending
     return None
@@ -145,11 +161,10 @@ def downloadSticker(c: CallbackContext, sticker: Sticker) -> Union[Text, None]:
                     
     if photo_to_use:
         photo_ending = "sticker_" + photo_id + ".webp"
-        path = downloads_path + "/" + photo_ending
+        path = storage.downloadPath(photo_ending)
         if not os.path.exists(path):
             file = c.bot.get_file(photo_to_use)
-            if not os.path.exists(downloads_path):
-                os.makedirs(downloads_path)
+            storage.ensureDirectory(path)
             file.download(custom_path=path)
             # TODO process photo
         return photo_ending
@@ -294,10 +309,25 @@ def listHandler(update: Update, context: CallbackContext) -> None:
         update.message.reply_text(entry.to_json())
         time.sleep(1)
 
-def main() -> None:
-    bowtiedb.init()
+def exportHandler(update: Update, context: CallbackContext) -> None:
+    if not allowedUser(update.message.from_user):
+        update.message.reply_text("401")
+        return
+    import archive
+    # Spooled to disk, the whole history does not have to fit in memory
+    with tempfile.TemporaryFile() as fh:
+        count = archive.export(fh, compress=True)
+        fh.seek(0)
+        filename = "bowtie-" + time.strftime("%Y%m%d-%H%M%S", time.gmtime()) + ".jsonl.gz"
+        update.message.reply_document(document=fh, filename=filename, caption=str(count) + " records")
+
+def createUpdater():
+    from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
     # Create the Updater and pass it your bot's token.
-    updater = Updater(token)
+    if api_url:
+        updater = Updater(token, base_url=api_url + "/bot", base_file_url=api_url + "/file/bot")
+    else:
+        updater = Updater(token)
 
     # guestbookdb.set_config("username", updater.bot.username)
     print("Starting bot " + updater.bot.username)
@@ -307,6 +337,7 @@ def main() -> None:
 
     # on different commands - answer in Telegram
     dispatcher.add_handler(CommandHandler("list", listHandler))
+    dispatcher.add_handler(CommandHandler("export", exportHandler))
 
     # on non command i.e message - echo the message on Telegram
     dispatcher.add_handler(MessageHandler(Filters.sticker, stickerHandler))
@@ -323,9 +354,102 @@ def main() -> None:
     #          [InlineKeyboardButton(name, callback_data="YES " + id)],
     #          [InlineKeyboardButton("\u274C", callback_data="NO " + id)]
     #       ]))
+    return updater
+
+def processUpdate(updater, data: Dict) -> None:
+    from telegram import Update
+    try:
+        update = Update.de_json(data, updater.bot)
+        updater.dispatcher.process_update(update)
+    except Exception as e:
+        logging.error("Failed to process update %s: %s", data.get("update_id"), e)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def do_POST(self) -> None:
+        if self.path != webhook_path:
+            self.send_error(404)
+            return
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), self.server.secret.encode()):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            data = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            # Queued before it is acknowledged, an update telegram was told
+            # about is handled even if the bot is stopping
+            self.server.executor.submit(processUpdate, self.server.updater, data)
+        except RuntimeError:
+            # Already stopped, telegram delivers it again later
+            self.send_error(503)
+            return
+        # Acknowledge right away, telegram only needs to know it arrived
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+class WebhookServer(ThreadingHTTPServer):
+    # server_close waits for requests in progress before the executor stops
+    daemon_threads = False
+
+    def __init__(self, updater, secret: Text):
+        super().__init__((webhook_listen, webhook_port), WebhookHandler)
+        self.updater = updater
+        self.secret = secret
+        self.executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+def startBot(updater) -> Optional[WebhookServer]:
+    if bot_mode != "webhook":
+        updater.start_polling()
+        return None
+    if not webhook_secret:
+        raise ValueError("WEBHOOK_SECRET is required in webhook mode")
+    server = WebhookServer(updater, webhook_secret)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    if webhook_url:
+        updater.bot.set_webhook(url=webhook_url, api_kwargs={"secret_token": webhook_secret})
+    logging.info("Listening for webhook updates on %s:%d%s", webhook_listen, webhook_port, webhook_path)
+    return server
+
+def stopBot(updater, server: Optional[WebhookServer]) -> None:
+    if server:
+        server.shutdown()
+        server.server_close()
+    updater.stop()
+
+def waitForSignal() -> None:
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    stop.wait()
+    logging.info("Stopping, finishing queued updates")
+
+def main() -> None:
+    bowtiedb.init()
+    updater = createUpdater()
 
     # Start the Bot
-    updater.start_polling()
+    server = startBot(updater)
+
+    if server:
+        # idle() only stops gracefully while polling, otherwise it exits on
+        # the spot and drops updates acknowledged but not yet handled
+        waitForSignal()
+        stopBot(updater, server)
+        return
 
     # Block until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
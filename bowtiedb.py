@@ -2,27 +2,66 @@ import sqlite3
 import threading
 import functools
 import os
+import zlib
+import json
 import logging
 import time
-from typing import Dict, List, Optional, Text, Union
-from dataclasses import dataclass
-from dataclasses_json.api import DataClassJsonMixin
-from marshmallow.fields import String
-
-from telegram.messageentity import MessageEntity
+import queue
+from typing import Callable, Dict, Iterator, List, Optional, Set, Text, Tuple, Union
+from dataclasses import dataclass, asdict, fields
 
 class ThreadDb(threading.local):
     con = None
     con: sqlite3.Connection
     cur = None
     cur: sqlite3.Cursor
+    # Set when entries were written in the current transaction
+    entries_changed = False
+    # Config values written in the current transaction, cached on commit
+    config_changes: Optional[Dict[Text, Optional[Text]]] = None
 
 
 localthreaddb = ThreadDb()
+# Optional pool of connections shared by every thread in the process, only
+# used when a single process hosts several services.
+connection_pool: Optional[queue.LifoQueue] = None
+entry_listeners: List[Callable[[], None]] = []
+# Seconds a cached config value is trusted before checking whether another
+# process has written the config since
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", "1"))
+
+def enable_pool(size: int) -> None:
+    global connection_pool
+    connection_pool = queue.LifoQueue(maxsize=size)
 
 def create_connection() -> sqlite3.Connection:
+    if connection_pool is not None:
+        try:
+            return connection_pool.get_nowait()
+        except queue.Empty:
+            # Pooled connections move between threads, one at a time
+            return sqlite3.connect(os.getenv("DB"), check_same_thread=False)
     return sqlite3.connect(os.getenv("DB"))
 
+def close_connection(con: sqlite3.Connection) -> None:
+    if connection_pool is not None:
+        try:
+            connection_pool.put_nowait(con)
+            return
+        except queue.Full:
+            pass
+    con.close()
+
+def add_entry_listener(listener: Callable[[], None]) -> None:
+    entry_listeners.append(listener)
+
+def notify_entry_listeners() -> None:
+    for listener in entry_listeners:
+        try:
+            listener()
+        except Exception as e:
+            logging.error("Entry listener failed: %s", e)
+
 
 def with_connection(func):
     @functools.wraps(func)
@@ -31,21 +70,30 @@ def with_connection(func):
         # Preserve old connection and cursor
         oldcon = localthreaddb.con
         oldcur = localthreaddb.cur
+        oldchanged = localthreaddb.entries_changed
+        oldconfig = localthreaddb.config_changes
         # Set current connection as the thread connection
         localthreaddb.con = con
         localthreaddb.cur = None
+        localthreaddb.entries_changed = False
+        localthreaddb.config_changes = dict()
         try:
             result = func(*args, **kwargs)
             con.commit()
+            config_cache.commit(localthreaddb.config_changes)
+            if localthreaddb.entries_changed:
+                notify_entry_listeners()
             return result
         except Exception as e:
             con.rollback()
             raise
         finally:
-            con.close()
+            close_connection(con)
             # Restore old connection and cursor
             localthreaddb.con = oldcon
             localthreaddb.cur = oldcur
+            localthreaddb.entries_changed = oldchanged
+            localthreaddb.config_changes = oldconfig
     return wrapper
 
 def with_retry(func):
@@ -85,30 +133,37 @@ def with_cursor(func):
             localthreaddb.con = con
             cur = con.cursor()
             localthreaddb.cur = con.cursor()
+            localthreaddb.entries_changed = False
+            localthreaddb.config_changes = dict()
             try:
                 result = func(*args, **kwargs)
                 con.commit()
+                config_cache.commit(localthreaddb.config_changes)
+                if localthreaddb.entries_changed:
+                    notify_entry_listeners()
                 return result
             except Exception as e:
                 con.rollback()
                 raise
             finally:
                 cur.close()
-                con.close()
+                close_connection(con)
                 # Clear both as the connection was only used for this invocation
                 localthreaddb.cur = None
                 localthreaddb.con = None
+                localthreaddb.entries_changed = False
+                localthreaddb.config_changes = None
     return wrapper
 
 @dataclass
-class TelegramMessageEntity(DataClassJsonMixin):
+class TelegramMessageEntity():
     type: str  # pylint: disable=W0622
     offset: int
     length: int
     url: Optional[Text] = None
 
 @dataclass
-class Entry(DataClassJsonMixin):
+class Entry():
     date: int
     content: Optional[Text]
     photo: Optional[Text]
@@ -117,53 +172,199 @@ class Entry(DataClassJsonMixin):
     icon: Optional[Text]
     identity: Optional[int] = None
 
+    def to_json(self) -> Text:
+        return json.dumps(asdict(self))
+
 @dataclass
-class Asset(DataClassJsonMixin):
-    source: String
-    variant: String
-    destination: String
+class Asset():
+    source: Text
+    variant: Text
+    destination: Text
     identity: Optional[int] = None
 
+@dataclass
+class SearchResult():
+    entry: Entry
+    snippet: Text
+    rank: float
+
+# Markers placed around matched terms by snippet(), chosen so that they
+# survive html escaping and can be swapped for real tags afterwards.
+SNIPPET_BEGIN = "\x02"
+SNIPPET_END = "\x03"
+
+# Entities are stored as a json list of objects with the same keys as
+# TelegramMessageEntity, unknown keys are ignored when reading.
+def encode_entities(entities: List[TelegramMessageEntity]) -> Text:
+    return json.dumps([asdict(entity) for entity in entities])
+
+def decode_entities(value: Text) -> List[TelegramMessageEntity]:
+    return entities_from_list(json.loads(value))
+
+def entities_from_list(items: List[Dict]) -> List[TelegramMessageEntity]:
+    names = set([f.name for f in fields(TelegramMessageEntity)])
+    entities = []
+    for item in items:
+        entities.append(TelegramMessageEntity(**dict([(k, v) for (k, v) in item.items() if k in names])))
+    return entities
+
+def entry_from_row(result) -> Entry:
+    entities_string = result[4]
+    entities = []
+    if entities_string:
+        entities = decode_entities(entities_string)
+    return Entry(result[1], result[2], result[3], entities, result[5], result[6], result[0])
+
+FIND_ENTRIES_SQL = "select id, date, content, photo, entities, display_name, icon from bowtie_entry order by date desc, id desc limit :limit offset :offset"
+FIND_ENTRIES_BEFORE_SQL = "select id, date, content, photo, entities, display_name, icon from bowtie_entry where (date, id) < (:date, :id) order by date desc, id desc limit :limit"
+FIND_ASSET_SQL = "select id, source, variant, destination from bowtie_asset where source = :source and variant = :variant"
+HAS_TWEET_SQL = "select id from bowtie_tweet where id = :id"
+READ_CONFIG_SQL = "select value from bowtie_config where name = :name"
+SET_CONFIG_SQL = "insert into bowtie_config(name, value) values (:name, :value) on conflict(name) do update set value = excluded.value"
+CONFIG_VERSION_SQL = "select version from bowtie_config_version"
+
 @with_cursor
 @with_retry
 def find_entries(limit:int=10,offset:int=0) -> List[Entry]:
-    results = localthreaddb.cur.execute("select id, date, content, photo, entities, display_name, icon from bowtie_entry order by date desc limit :limit offset :offset", {
+    results = localthreaddb.cur.execute(FIND_ENTRIES_SQL, {
         "limit": limit,
         "offset": offset
     }).fetchall()
     if results and len(results) > 0:
         entries = []
         for result in results:
-            entities_string = result[4]
-            entities = []
-            if entities_string:
-                entities = TelegramMessageEntity.schema(many=True).loads(entities_string)
-        
-            entries.append(Entry(result[1], result[2], result[3], entities, result[5], result[6], result[0]))
+            entries.append(entry_from_row(result))
         # logging.info("Found %d entries", len(results))
         return entries
     return []
 
 @with_cursor
 @with_retry
-def add_entry(entry: Entry) -> None:
+def find_entries_before(date: int, identity: int, limit:int=10) -> List[Entry]:
+    results = localthreaddb.cur.execute(FIND_ENTRIES_BEFORE_SQL, {
+        "date": date,
+        "id": identity,
+        "limit": limit
+    }).fetchall()
+    return [entry_from_row(result) for result in results]
+
+def iter_entries(limit:int, batch_size:int=50) -> Iterator[Entry]:
+    # Keyset pagination, only one batch of entries is held at a time
+    date = 2 ** 62
+    identity = 2 ** 62
+    while limit > 0:
+        entries = find_entries_before(date, identity, min(batch_size, limit))
+        for entry in entries:
+            yield entry
+        if len(entries) < min(batch_size, limit):
+            return
+        limit -= len(entries)
+        date = entries[-1].date
+        identity = entries[-1].identity
+
+def fts_query(text: Text) -> Text:
+    # Quote every term so that user input is never parsed as FTS5 syntax,
+    # the terms are then implicitly AND'ed together.
+    terms = []
+    for term in text.split():
+        terms.append('"' + term.replace('"', '""') + '"')
+    return " ".join(terms)
+
+@with_cursor
+@with_retry
+def search_entries(text: Text, limit:int=10, offset:int=0) -> List[SearchResult]:
+    query = fts_query(text)
+    if not query:
+        return []
+    results = localthreaddb.cur.execute("select e.id, e.date, e.content, e.photo, e.entities, e.display_name, e.icon, snippet(bowtie_entry_fts, 0, :begin, :end, '...', 24), bowtie_entry_fts.rank from bowtie_entry_fts join bowtie_entry e on e.id = bowtie_entry_fts.rowid where bowtie_entry_fts match :query order by bowtie_entry_fts.rank limit :limit offset :offset", {
+        "begin": SNIPPET_BEGIN,
+        "end": SNIPPET_END,
+        "query": query,
+        "limit": limit,
+        "offset": offset
+    }).fetchall()
+    search_results = []
+    for result in results:
+        search_results.append(SearchResult(entry_from_row(result), result[7] or "", result[8]))
+    return search_results
+
+def entry_params(entry: Entry) -> Dict:
     encoded_entities = None
     if entry.entities:
-        encoded_entities = TelegramMessageEntity.schema(many=True).dumps(entry.entities)
-    localthreaddb.cur.execute("insert into bowtie_entry(date, content, photo, entities, display_name, icon) values (:date, :content, :photo, :entities, :display_name, :icon)", {
+        encoded_entities = encode_entities(entry.entities)
+    return {
         "date": entry.date,
         "content": entry.content,
         "photo": entry.photo,
         "entities": encoded_entities,
         "display_name": entry.display_name,
         "icon": entry.icon
-    })
-        
+    }
+
+@with_cursor
+@with_retry
+def add_entry(entry: Entry) -> None:
+    localthreaddb.cur.execute("insert into bowtie_entry(date, content, photo, entities, display_name, icon) values (:date, :content, :photo, :entities, :display_name, :icon)", entry_params(entry))
+    # Listeners hear about it once the transaction commits
+    localthreaddb.entries_changed = True
+
+@with_cursor
+@with_retry
+def add_entries(entries: List[Entry]) -> None:
+    if not entries:
+        return
+    localthreaddb.cur.executemany("insert into bowtie_entry(date, content, photo, entities, display_name, icon) values (:date, :content, :photo, :entities, :display_name, :icon)",
+        [entry_params(entry) for entry in entries])
+    localthreaddb.entries_changed = True
+
+@with_cursor
+@with_retry
+def find_entries_after_id(identity: int, limit: int) -> List[Entry]:
+    # Keyset over the primary key, in insertion order
+    results = localthreaddb.cur.execute("select id, date, content, photo, entities, display_name, icon from bowtie_entry where id > :id order by id limit :limit", {
+        "id": identity,
+        "limit": limit
+    }).fetchall()
+    return [entry_from_row(result) for result in results]
+
+def same_entry(a: Entry, b: Entry) -> bool:
+    return (a.date, a.content, a.photo, a.entities, a.display_name, a.icon) == (b.date, b.content, b.photo, b.entities, b.display_name, b.icon)
+
+@with_cursor
+@with_retry
+def has_same_entry(entry: Entry) -> bool:
+    results = localthreaddb.cur.execute("select id, date, content, photo, entities, display_name, icon from bowtie_entry where date = :date", {
+        "date": entry.date
+    }).fetchall()
+    return any([same_entry(entry_from_row(result), entry) for result in results])
+
+@with_cursor
+@with_retry
+def import_entries(entries: List[Entry]) -> Tuple[int, List[Entry]]:
+    # Keeps the original ids. An entry that is already present, under its
+    # own id or one given by an earlier import, is skipped. Returns the
+    # number of entries written and the entries whose id belongs to a
+    # different entry, nothing refers to entries by id so those can be
+    # added with new ones.
+    written = 0
+    taken = []
+    for entry in entries:
+        if has_same_entry(entry):
+            continue
+        localthreaddb.cur.execute("insert into bowtie_entry(id, date, content, photo, entities, display_name, icon) values (:id, :date, :content, :photo, :entities, :display_name, :icon) on conflict(id) do nothing",
+            dict(entry_params(entry), id=entry.identity))
+        if localthreaddb.cur.rowcount == 0:
+            taken.append(entry)
+        else:
+            written += 1
+    if written:
+        localthreaddb.entries_changed = True
+    return (written, taken)
 
 @with_cursor
 @with_retry
 def add_asset(asset: Asset) -> None:
-    localthreaddb.cur.execute("insert into bowtie_asset(source, variant, destination) values (:source, :variant, :destination)", {
+    localthreaddb.cur.execute("insert into bowtie_asset(source, variant, destination) values (:source, :variant, :destination) on conflict(source, variant) do update set destination = excluded.destination", {
         "source": asset.source,
         "variant": asset.variant,
         "destination": asset.destination
@@ -171,8 +372,8 @@ def add_asset(asset: Asset) -> None:
 
 @with_cursor
 @with_retry
-def find_asset(source: String, variant: String) -> Optional[Asset]:
-    results = localthreaddb.cur.execute("select id, source, variant, destination from bowtie_asset where source = :source and variant = :variant", {
+def find_asset(source: Text, variant: Text) -> Optional[Asset]:
+    results = localthreaddb.cur.execute(FIND_ASSET_SQL, {
         "source": source,
         "variant": variant
     }).fetchone()
@@ -180,11 +381,85 @@ def find_asset(source: String, variant: String) -> Optional[Asset]:
         return Asset(results[1], results[2], results[3], results[0])
     return None
 
+@with_cursor
+@with_retry
+def find_assets() -> List[Asset]:
+    results = localthreaddb.cur.execute("select id, source, variant, destination from bowtie_asset").fetchall()
+    assets = []
+    for result in results:
+        assets.append(Asset(result[1], result[2], result[3], result[0]))
+    return assets
+
+@with_cursor
+@with_retry
+def add_assets(assets: List[Asset]) -> int:
+    # Returns the number of rows added or changed
+    localthreaddb.cur.executemany("insert into bowtie_asset(source, variant, destination) values (:source, :variant, :destination) on conflict(source, variant) do update set destination = excluded.destination where destination != excluded.destination",
+        [{"source": asset.source, "variant": asset.variant, "destination": asset.destination} for asset in assets])
+    return localthreaddb.cur.rowcount
+
+@with_cursor
+@with_retry
+def find_assets_after_id(identity: int, limit: int) -> List[Asset]:
+    results = localthreaddb.cur.execute("select id, source, variant, destination from bowtie_asset where id > :id order by id limit :limit", {
+        "id": identity,
+        "limit": limit
+    }).fetchall()
+    return [Asset(result[1], result[2], result[3], result[0]) for result in results]
+
+@with_cursor
+@with_retry
+def delete_asset(identity: int) -> None:
+    localthreaddb.cur.execute("delete from bowtie_asset where id = :id", {"id": identity})
+
+@with_cursor
+@with_retry
+def find_entry_media() -> Set[Text]:
+    results = localthreaddb.cur.execute("select photo from bowtie_entry where photo is not null union select icon from bowtie_entry where icon is not null").fetchall()
+    return set([result[0] for result in results])
+
+@with_cursor
+@with_retry
+def latest_change() -> int:
+    # sqlite_sequence keeps counting after old changes are pruned
+    results = localthreaddb.cur.execute("select seq from sqlite_sequence where name = 'bowtie_change'").fetchone()
+    if results:
+        return results[0]
+    return 0
+
+@with_cursor
+@with_retry
+def find_changed_entries(after: int) -> Set[int]:
+    results = localthreaddb.cur.execute("select distinct entry_id from bowtie_change where seq > :seq", {"seq": after}).fetchall()
+    return set([result[0] for result in results])
+
+@with_cursor
+@with_retry
+def delete_changes(up_to: int) -> None:
+    localthreaddb.cur.execute("delete from bowtie_change where seq <= :seq", {"seq": up_to})
+
+@with_cursor
+@with_retry
+def find_page_hashes() -> Dict[Text, Text]:
+    results = localthreaddb.cur.execute("select name, hash from bowtie_page").fetchall()
+    return dict([(result[0], result[1]) for result in results])
+
+@with_cursor
+@with_retry
+def set_page_hashes(hashes: Dict[Text, Text]) -> None:
+    localthreaddb.cur.executemany("insert into bowtie_page(name, hash) values (:name, :hash) on conflict(name) do update set hash = excluded.hash",
+        [{"name": name, "hash": value} for (name, value) in hashes.items()])
+
+@with_cursor
+@with_retry
+def delete_page_hash(name: Text) -> None:
+    localthreaddb.cur.execute("delete from bowtie_page where name = :name", {"name": name})
+
 @with_connection
 @with_cursor
 @with_retry
 def has_tweet(identity: int) -> bool:
-    results = localthreaddb.cur.execute("select id from bowtie_tweet where id = :id", {
+    results = localthreaddb.cur.execute(HAS_TWEET_SQL, {
         "id": identity
     }).fetchone()
     if results and len(results) > 0:
@@ -194,46 +469,322 @@ def has_tweet(identity: int) -> bool:
 @with_cursor
 @with_retry
 def has_tweet(identity: int) -> bool:
-    results = localthreaddb.cur.execute("select id from bowtie_tweet where id = :id", {
+    results = localthreaddb.cur.execute(HAS_TWEET_SQL, {
         "id": identity
     }).fetchone()
     if results and len(results) > 0:
         return True
     return False
 
+# Tweets are stored as zlib streams primed with this dictionary of
+# fragments that show up in nearly every tweet payload. The dictionary can
+# never change for a given format tag or old rows become unreadable.
+TWEET_FORMAT_ZLIB_V1 = b"z1"
+TWEET_DICTIONARY_V1 = (
+    b'"profile_image_url_https": "https://pbs.twimg.com/profile_images/'
+    b'"media_url_https": "https://pbs.twimg.com/media/", "url": "https://t.co/", '
+    b'"display_url": "pic.twitter.com/", "expanded_url": "https://twitter.com/'
+    b'"indices": [, "sizes": {"thumb": {"w": 150, "h": 150, "resize": "crop"}, '
+    b'"medium": {"w": 1200, "h": "resize": "fit"}, "small": {"w": 680, '
+    b'"large": {"w": 2048, "type": "photo"}, "in_reply_to_status_id": null, '
+    b'"entities": {"hashtags": [], "symbols": [], "user_mentions": [], "urls": [], '
+    b'"extended_entities": {"media": [{"id": "id_str": "media_url": "http://pbs.twimg.com/media/'
+    b'"user": {"id": "id_str": "name": "screen_name": "profile_image_url": "http://pbs.twimg.com/profile_images/'
+    b'"lang": "en", "display_text_range": [0, "full_text": "created_at": "+0000 20'
+)
+
+def compress_tweet(value: Text) -> bytes:
+    compressor = zlib.compressobj(9, zdict=TWEET_DICTIONARY_V1)
+    return TWEET_FORMAT_ZLIB_V1 + compressor.compress(value.encode("utf-8")) + compressor.flush()
+
+def decompress_tweet(value: Union[bytes, Text]) -> Text:
+    if isinstance(value, str):
+        # Stored before compression was introduced
+        return value
+    if value.startswith(TWEET_FORMAT_ZLIB_V1):
+        decompressor = zlib.decompressobj(zdict=TWEET_DICTIONARY_V1)
+        data = decompressor.decompress(value[len(TWEET_FORMAT_ZLIB_V1):]) + decompressor.flush()
+        return data.decode("utf-8")
+    raise ValueError("Unknown tweet storage format")
+
 @with_cursor
 @with_retry
 def save_tweet(identity: int, json: Text) -> None:
     localthreaddb.cur.execute("insert into bowtie_tweet(id, json) values (:id, :json)", {
         "id": identity,
-        "json": json
+        "json": compress_tweet(json)
     })
 
-@with_connection
 @with_cursor
 @with_retry
-def read_config(name: Text) -> Union[Text, None]:
-    results = localthreaddb.cur.execute("select value from bowtie_config where name = :name", {"name": name}).fetchone()
-    if results and len(results) > 0:
-        return results[0]
+def save_tweets(tweets: List[Tuple[int, Text]]) -> Set[int]:
+    # A poller and a backfill can both fetch the newest tweets, whichever
+    # commits second skips them. Returns the ids actually written.
+    saved = set()
+    for (identity, value) in tweets:
+        localthreaddb.cur.execute("insert into bowtie_tweet(id, json) values (:id, :json) on conflict(id) do nothing", {
+            "id": identity,
+            "json": compress_tweet(value)
+        })
+        if localthreaddb.cur.rowcount > 0:
+            saved.add(identity)
+    return saved
+
+@with_cursor
+@with_retry
+def import_tweets(tweets: List[Tuple[int, Text]]) -> int:
+    # A tweet id is the tweet, one already stored is the same tweet.
+    # Returns the number of tweets written.
+    localthreaddb.cur.executemany("insert into bowtie_tweet(id, json) values (:id, :json) on conflict(id) do nothing",
+        [{"id": identity, "json": compress_tweet(value)} for (identity, value) in tweets])
+    return localthreaddb.cur.rowcount
+
+@with_cursor
+@with_retry
+def find_tweets_after_id(identity: int, limit: int) -> List[Tuple[int, Text]]:
+    results = localthreaddb.cur.execute("select id, json from bowtie_tweet where id > :id order by id limit :limit", {
+        "id": identity,
+        "limit": limit
+    }).fetchall()
+    return [(result[0], decompress_tweet(result[1])) for result in results]
+
+@with_cursor
+@with_retry
+def find_tweet_ids(identities: List[int]) -> Set[int]:
+    if not identities:
+        return set()
+    placeholders = ", ".join(["?"] * len(identities))
+    results = localthreaddb.cur.execute("select id from bowtie_tweet where id in (" + placeholders + ")", identities).fetchall()
+    return set([result[0] for result in results])
+
+@with_cursor
+@with_retry
+def read_tweet(identity: int) -> Optional[dict]:
+    results = localthreaddb.cur.execute("select json from bowtie_tweet where id = :id", {
+        "id": identity
+    }).fetchone()
+    if results and results[0] is not None:
+        return json.loads(decompress_tweet(results[0]))
     return None
 
-@with_connection
+def compress_tweets(cur: sqlite3.Cursor) -> None:
+    # One time conversion of rows written as plain json text
+    count = 0
+    while True:
+        results = cur.execute("select id, json from bowtie_tweet where typeof(json) = 'text' limit 500").fetchall()
+        if not results:
+            break
+        for result in results:
+            cur.execute("update bowtie_tweet set json = :json where id = :id", {
+                "id": result[0],
+                "json": compress_tweet(result[1])
+            })
+        count += len(results)
+    if count > 0:
+        logging.info("Compressed %d stored tweets", count)
+
+class ConfigCache():
+    # Read through cache of bowtie_config. Every write, from any process,
+    # bumps bowtie_config_version, so checking that one row once per TTL is
+    # enough to notice values changed elsewhere.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: Dict[Text, Optional[Text]] = dict()
+        self.version: Optional[int] = None
+        self.checked = 0.0
+
+    def lookup(self, name: Text) -> Tuple[bool, Optional[Text]]:
+        # Needs no connection, a miss or an expired check goes to refresh
+        with self.lock:
+            if time.monotonic() - self.checked < CONFIG_CACHE_TTL and name in self.values:
+                return (True, self.values[name])
+        return (False, None)
+
+    def refresh(self, cur: sqlite3.Cursor) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked < CONFIG_CACHE_TTL:
+                return
+        version = cur.execute(CONFIG_VERSION_SQL).fetchone()[0]
+        with self.lock:
+            if version != self.version:
+                self.values.clear()
+                self.version = version
+            self.checked = now
+
+    def store(self, name: Text, value: Optional[Text]) -> None:
+        with self.lock:
+            self.values[name] = value
+
+    def commit(self, changes: Optional[Dict[Text, Optional[Text]]]) -> None:
+        if changes:
+            with self.lock:
+                self.values.update(changes)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
+            self.version = None
+            self.checked = 0.0
+
+config_cache = ConfigCache()
+
+def read_config(name: Text) -> Union[Text, None]:
+    # Values written earlier in this transaction are not cached until it commits
+    changes = localthreaddb.config_changes
+    if changes and name in changes:
+        return changes[name]
+    (cached, value) = config_cache.lookup(name)
+    if cached:
+        return value
+    return read_config_row(name)
+
 @with_cursor
 @with_retry
+def read_config_row(name: Text) -> Union[Text, None]:
+    config_cache.refresh(localthreaddb.cur)
+    (cached, value) = config_cache.lookup(name)
+    if cached:
+        return value
+    results = localthreaddb.cur.execute(READ_CONFIG_SQL, {"name": name}).fetchone()
+    value = results[0] if results else None
+    if not localthreaddb.con.in_transaction:
+        # Inside a transaction the row may be one this transaction wrote
+        # without set_config, only cache what is committed
+        config_cache.store(name, value)
+    return value
+
 def set_config(name: Text, value: Text) -> None:
-    if read_config(name) is None:
-        localthreaddb.cur.execute("insert into bowtie_config(name, value) values (:name, :value)", {"name": name, "value": value})
-    else:
-        localthreaddb.cur.execute("update bowtie_config set value = :value where name = :name", {"name": name, "value": value})
+    set_configs({name: value})
 
-@with_connection
 @with_cursor
-def init() -> None:
-    cur = localthreaddb.cur
+@with_retry
+def set_configs(values: Dict[Text, Text]) -> None:
+    localthreaddb.cur.executemany(SET_CONFIG_SQL, [{"name": name, "value": value} for (name, value) in values.items()])
+    if localthreaddb.config_changes is not None:
+        localthreaddb.config_changes.update(values)
+
+@with_cursor
+@with_retry
+def delete_configs(names: List[Text]) -> None:
+    localthreaddb.cur.executemany("delete from bowtie_config where name = :name", [{"name": name} for name in names])
+    if localthreaddb.config_changes is not None:
+        localthreaddb.config_changes.update(dict([(name, None) for name in names]))
+
+def migrate_baseline(cur: sqlite3.Cursor) -> None:
     cur.execute("create table if not exists bowtie_config (name text primary key, value text)")
     cur.execute("create table if not exists bowtie_entry (id integer primary key autoincrement, date int, content text, photo text, entities text, display_name text, icon text)")
     cur.execute("create index if not exists bowtie_entry_date on bowtie_entry(date)")
     cur.execute("create table if not exists bowtie_asset (id integer primary key autoincrement, source text, variant text, destination text)")
     cur.execute("create index if not exists bowtie_asset_source on bowtie_asset(source, variant)")
     cur.execute("create table if not exists bowtie_tweet (id int primary key, json text)")
+
+def migrate_entry_fts(cur: sqlite3.Cursor) -> None:
+    # Full text index over entries, kept in sync with bowtie_entry by triggers
+    cur.execute("create virtual table if not exists bowtie_entry_fts using fts5(content, display_name, content='bowtie_entry', content_rowid='id')")
+    cur.execute("""create trigger if not exists bowtie_entry_fts_insert after insert on bowtie_entry begin
+        insert into bowtie_entry_fts(rowid, content, display_name) values (new.id, new.content, new.display_name);
+    end""")
+    cur.execute("""create trigger if not exists bowtie_entry_fts_delete after delete on bowtie_entry begin
+        insert into bowtie_entry_fts(bowtie_entry_fts, rowid, content, display_name) values ('delete', old.id, old.content, old.display_name);
+    end""")
+    cur.execute("""create trigger if not exists bowtie_entry_fts_update after update on bowtie_entry begin
+        insert into bowtie_entry_fts(bowtie_entry_fts, rowid, content, display_name) values ('delete', old.id, old.content, old.display_name);
+        insert into bowtie_entry_fts(rowid, content, display_name) values (new.id, new.content, new.display_name);
+    end""")
+    # Index entries that were written before the index existed
+    cur.execute("insert into bowtie_entry_fts(bowtie_entry_fts) values ('rebuild')")
+
+def migrate_compress_tweets(cur: sqlite3.Cursor) -> None:
+    compress_tweets(cur)
+    # Marker used before migrations were tracked in user_version
+    cur.execute("delete from bowtie_config where name = 'tweet_format'")
+
+def migrate_entry_listing_index(cur: sqlite3.Cursor) -> None:
+    # Matches "order by date desc, id desc" so listing and keyset pages walk
+    # the index in order and stop at the limit
+    cur.execute("create index if not exists bowtie_entry_date_id on bowtie_entry(date desc, id desc)")
+    cur.execute("drop index if exists bowtie_entry_date")
+
+def migrate_unique_assets(cur: sqlite3.Cursor) -> None:
+    # Racing builds could insert the same asset twice, keep the newest
+    cur.execute("delete from bowtie_asset where id not in (select max(id) from bowtie_asset group by source, variant)")
+    cur.execute("create unique index if not exists bowtie_asset_source_variant on bowtie_asset(source, variant)")
+    cur.execute("drop index if exists bowtie_asset_source")
+
+def migrate_config_version(cur: sqlite3.Cursor) -> None:
+    # Bumped on every config write so cached values can be checked cheaply
+    cur.execute("create table if not exists bowtie_config_version (id integer primary key check (id = 0), version int not null)")
+    cur.execute("insert or ignore into bowtie_config_version(id, version) values (0, 0)")
+    for event in ["insert", "update", "delete"]:
+        cur.execute("create trigger if not exists bowtie_config_version_" + event + " after " + event + " on bowtie_config begin "
+            + "update bowtie_config_version set version = version + 1; end")
+
+def migrate_build_journal(cur: sqlite3.Cursor) -> None:
+    # Every write to an entry is journaled, the generator remembers the last
+    # change it built and the hash of every page it wrote
+    cur.execute("create table if not exists bowtie_change (seq integer primary key autoincrement, entry_id int not null)")
+    cur.execute("create trigger if not exists bowtie_change_insert after insert on bowtie_entry begin insert into bowtie_change(entry_id) values (new.id); end")
+    cur.execute("create trigger if not exists bowtie_change_update after update on bowtie_entry begin insert into bowtie_change(entry_id) values (new.id); end")
+    cur.execute("create trigger if not exists bowtie_change_delete after delete on bowtie_entry begin insert into bowtie_change(entry_id) values (old.id); end")
+    cur.execute("create table if not exists bowtie_page (name text primary key, hash text not null)")
+
+# Applied in order, the database's user_version is the number applied so
+# far. Only ever append to this list.
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    migrate_baseline,
+    migrate_entry_fts,
+    migrate_compress_tweets,
+    migrate_entry_listing_index,
+    migrate_unique_assets,
+    migrate_config_version,
+    migrate_build_journal,
+]
+
+@with_connection
+@with_cursor
+def init() -> None:
+    con = localthreaddb.con
+    cur = localthreaddb.cur
+    for version in range(1, len(MIGRATIONS) + 1):
+        # Take the write lock before looking, another process may be
+        # migrating the same database right now
+        cur.execute("begin immediate")
+        current = cur.execute("pragma user_version").fetchone()[0]
+        if current >= version:
+            con.rollback()
+            continue
+        logging.info("Migrating database to version %d: %s", version, MIGRATIONS[version - 1].__name__)
+        MIGRATIONS[version - 1](cur)
+        cur.execute("pragma user_version = " + str(version))
+        con.commit()
+
+# Queries on hot paths and the index each one must use
+HOT_QUERIES = [
+    (FIND_ENTRIES_SQL, {"limit": 10, "offset": 0}, "bowtie_entry_date_id"),
+    (FIND_ENTRIES_BEFORE_SQL, {"date": 0, "id": 0, "limit": 10}, "bowtie_entry_date_id"),
+    (FIND_ASSET_SQL, {"source": "", "variant": ""}, "bowtie_asset_source_variant"),
+    (READ_CONFIG_SQL, {"name": ""}, "sqlite_autoindex_bowtie_config_1"),
+    (HAS_TWEET_SQL, {"id": 0}, "sqlite_autoindex_bowtie_tweet_1"),
+]
+
+@with_connection
+@with_cursor
+def check_query_plans() -> List[Text]:
+    failures = []
+    for (sql, params, index) in HOT_QUERIES:
+        plan = localthreaddb.cur.execute("explain query plan " + sql, params).fetchall()
+        details = " ".join([row[-1] for row in plan])
+        if ("USING INDEX " + index) not in details and ("USING COVERING INDEX " + index) not in details:
+            failures.append(sql + "\n    expected " + index + ", got: " + details)
+    return failures
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        init()
+        failures = check_query_plans()
+        for failure in failures:
+            print("FAIL " + failure)
+        print(str(len(HOT_QUERIES) - len(failures)) + "/" + str(len(HOT_QUERIES)) + " hot queries use their index")
+        sys.exit(1 if failures else 0)
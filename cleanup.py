@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+import argparse
+from typing import Iterator, List, Text, Tuple
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+import bowtiedb
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+load_dotenv()
+
+downloads_path = os.environ["DOWNLOADS_PATH"]
+web_path = os.environ["WEB_PATH"]
+RETENTION_DAYS = float(os.getenv("GC_RETENTION_DAYS", "7"))
+# Only files with these endings are generated variants, pages, feeds and
+# static content in the web path are never collected.
+VARIANT_EXTENSIONS = (".jpg", ".gif")
+
+@dataclass
+class Plan():
+    stale_assets: List[bowtiedb.Asset] = field(default_factory=list)
+    files: List[Tuple[Text, int]] = field(default_factory=list)
+
+    def reclaimable(self) -> int:
+        return sum([size for (_, size) in self.files])
+
+def walkFiles(root: Text) -> Iterator[Tuple[Text, os.stat_result]]:
+    for (directory, _, names) in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                yield (os.path.relpath(path, root), os.stat(path))
+            except FileNotFoundError:
+                # Removed while walking
+                continue
+
+@bowtiedb.with_connection
+def makePlan(cutoff: float) -> Plan:
+    plan = Plan()
+    # Everything created after this point has a newer mtime than the cutoff
+    # and is left alone, so a concurrent build cannot lose a fresh variant.
+    media = bowtiedb.find_entry_media()
+    destinations = set()
+    live = set()
+    for asset in bowtiedb.find_assets():
+        destinations.add(asset.destination)
+        if asset.source in media:
+            live.add(asset.destination)
+        else:
+            plan.stale_assets.append(asset)
+
+    for (name, stat) in walkFiles(web_path):
+        if not name.endswith(VARIANT_EXTENSIONS) or name in live:
+            continue
+        if stat.st_mtime < cutoff:
+            plan.files.append((os.path.join(web_path, name), stat.st_size))
+        elif name in destinations:
+            # Too new to delete, keep the row that points to it as well
+            plan.stale_assets = [asset for asset in plan.stale_assets if asset.destination != name]
+
+    for (name, stat) in walkFiles(downloads_path):
+        # Downloads are sharded into subdirectories, entries only know the name
+        if os.path.basename(name) in media or stat.st_mtime >= cutoff:
+            continue
+        plan.files.append((os.path.join(downloads_path, name), stat.st_size))
+    return plan
+
+@bowtiedb.with_connection
+def deleteAssets(assets: List[bowtiedb.Asset]) -> None:
+    for asset in assets:
+        bowtiedb.delete_asset(asset.identity)
+
+def collect(retention_days: float, dry_run: bool) -> int:
+    cutoff = time.time() - retention_days * 86400
+    plan = makePlan(cutoff)
+    if dry_run:
+        for asset in plan.stale_assets:
+            logging.info("Would forget asset %s %s -> %s", asset.source, asset.variant, asset.destination)
+        for (path, size) in plan.files:
+            logging.info("Would delete %s (%d bytes)", path, size)
+        logging.info("Dry run: %d assets and %d files, %d bytes reclaimable",
+            len(plan.stale_assets), len(plan.files), plan.reclaimable())
+        return plan.reclaimable()
+    # Rows go first so nothing can look up a variant that is about to vanish
+    deleteAssets(plan.stale_assets)
+    reclaimed = 0
+    for (path, size) in plan.files:
+        try:
+            os.remove(path)
+            reclaimed += size
+            logging.info("Deleted %s", path)
+        except FileNotFoundError:
+            pass
+    logging.info("Forgot %d assets, deleted %d files, reclaimed %d bytes",
+        len(plan.stale_assets), len(plan.files), reclaimed)
+    return reclaimed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Remove downloads and web variants no entry refers to")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    parser.add_argument("--retention-days", type=float, default=RETENTION_DAYS,
+        help="never remove files modified more recently than this")
+    args = parser.parse_args()
+    bowtiedb.init()
+    collect(args.retention_days, args.dry_run)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,23 @@
 import os
 import traceback
 import sys
-import uuid
 import time
 import json
-import pysftp
+import hashlib
 import logging
 import datetime
 import html
+import shutil
 import subprocess
-import ffmpeg
-from distutils import dir_util
-from typing import Dict, List, Text, Tuple, Union, Optional
-from dataclasses import dataclass
+import tempfile
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, Set, Text, Tuple, Union, Optional
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 import bowtiedb
+import storage
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,11 +31,39 @@ sftp_host = os.environ["SFTP_HOST"]
 sftp_user = os.environ["SFTP_USER"]
 sftp_pass = os.environ["SFTP_PASS"]
 sftp_path = os.environ["SFTP_PATH"]
+site_url = os.getenv("SITE_URL", "").rstrip("/")
 VARIANT_256 = "256x256jpg"
 VARIANT_128 = "128x128jpg"
 VARIANT_128GIF = "128x128gif"
+VARIANT_128POSTER = "128x128poster"
+# Everything that affects the bytes of a variant, part of its file name
+VARIANT_ENCODING = {
+    VARIANT_256: ["-background", "#3f2e26", "-flatten", "-resize", "256x256>", "-alpha", "off"],
+    VARIANT_128: ["-background", "#3f2e26", "-flatten", "-resize", "128x128>", "-alpha", "off"],
+    VARIANT_128GIF: {"size": 128, "duration": 10, "frames": 20, "rate": 10},
+    VARIANT_128POSTER: {"size": 128, "frames": 1},
+}
+VARIANT_EXTENSIONS = {
+    VARIANT_256: ".jpg",
+    VARIANT_128: ".jpg",
+    VARIANT_128GIF: ".gif",
+    VARIANT_128POSTER: ".jpg",
+}
 PAGE_BUDGET = 120_000
+# "inline" embeds animations, "poster" shows their first frame linked to
+# the animation so only the frame counts against the page budget
+ANIMATION_MODE = os.getenv("ANIMATION_MODE", "inline")
+BUILD_LIMIT = int(os.getenv("BUILD_LIMIT", "100"))
+# Full rebuilds render shards of entries on this many processes
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS") or os.cpu_count() or 1)
+SHARD_SIZE = 25
+FEED_SIZE = 20
+FEED_FILENAME = "feed.xml"
+# Build journal, see build()
+BUILD_SEQ = "build_seq"
+BUILD_SIGNATURE = "build_signature"
 
+SEARCH_FORM = '<form action="search" method="get"><input type="text" name="q" value=""> <input type="submit" value="Search"></form>'
 TEMPLATE_BEGIN = """
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">
 <html>
@@ -41,10 +72,12 @@ TEMPLATE_BEGIN = """
 <meta name="viewport" content="width=device-width">
 <title>Cendyne Bowtie Blog</title>
 <meta name="robots" content="noindex">
+<link rel="alternate" type="application/atom+xml" title="Cendyne Bowtie Blog" href="feed.xml">
 </head>
 <body bgcolor="#3F2E26">
 <table align="center" border="0" cellpadding="20" width="460">
 <!--<tr><td align="center"><a href="/"><font color="#f7b2a9">The Digital Bowtie Lodge</font></a></td></tr>-->
+<tr><td align="center">""" + SEARCH_FORM + """</td></tr>
 </table>
 """
 NAV_BEGIN = """
@@ -65,83 +98,137 @@ TEMPLATE_END = """
 </body>
 </html>
 """
+# Encoded once, pages are written from these pieces
+PAGE_BEGIN_BYTES = TEMPLATE_BEGIN.encode("iso-8859-1", 'ignore')
+ENTRIES_BEGIN_BYTES = ENTRIES_BEGIN.encode("iso-8859-1", 'ignore')
+ENTRIES_END_BYTES = ENTRIES_END.encode("iso-8859-1", 'ignore')
+TEMPLATE_END_BYTES = TEMPLATE_END.encode("iso-8859-1", 'ignore')
+FEED_BEGIN = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>Cendyne Bowtie Blog</title>
+<id>urn:bowtie:feed</id>
+"""
+FEED_END = """</feed>
+"""
+
+# Content hashes of downloads keyed by name, mtime and size
+source_hashes: Dict[Tuple[Text, int, int], Text] = dict()
 
 @dataclass
 class State():
-    lastEntry: Optional[bowtiedb.Entry] = None
-
-def getLatestEntry() -> Optional[bowtiedb.Entry]:
-    entries = bowtiedb.find_entries(limit=1)
-    if len(entries) > 0:
-        return entries[0]
-    return None
-
-def makeAsset(variant, source, destination):
-    web_dest = web_path + "/" + destination
-    download_source = downloads_path + "/" + source
-    if not os.path.exists(web_dest):
-        if variant == VARIANT_256:
-            result = subprocess.Popen([
-                "convert",
-                download_source,
-                "-background", "#3f2e26",
-                "-flatten",
-                "-resize", "256x256>",
-                "-alpha", "off",
-                web_dest
-                ])
-            text = result.communicate()[0]
-            return_code = result.returncode
-            logging.info("Converted %s to %s: %s", source, destination, text)
-            if return_code != 0:
-                logging.warn("convert exited with code %d", return_code)
-            else:
-                # Save successfully created assets
-                bowtiedb.add_asset(bowtiedb.Asset(source, variant, destination))
-        elif variant == VARIANT_128:
-            result = subprocess.Popen([
-                "convert",
-                download_source,
-                "-background", "#3f2e26",
-                "-flatten",
-                "-resize", "128x128>",
-                "-alpha", "off",
-                web_dest
-                ])
-            text = result.communicate()[0]
-            return_code = result.returncode
-            logging.info("Converted %s to %s: %s", source, destination, text)
-            if return_code != 0:
-                logging.warn("convert exited with code %d", return_code)
-            else:
-                # Save successfully created assets
-                bowtiedb.add_asset(bowtiedb.Asset(source, variant, destination))
-        elif variant == VARIANT_128GIF:
-            result = ffmpeg.probe(download_source)
-            stream = result["streams"][0]
-            width = stream["width"]
-            height = stream["height"]
-            ratio = min(min(128, width) / width, min(128, height) / height)
-            duration = float(stream["duration"])
-            resized_height = int(ratio * height)
-            resized_width = int(ratio * width)
-            stream = ffmpeg.input(download_source)
-
-            if duration > 10:
-                stream = ffmpeg.trim(stream, duration=10)
-            if duration > 2:
-                rate = int(max(min(20 / duration, 10), 1))
-            else:
-                rate = 10
-            if duration > 10:
-                stream = ffmpeg.trim(stream, duration=10)
-            stream = ffmpeg.filter(stream, 'scale', str(resized_width), str(resized_height))
-            stream = ffmpeg.output(stream, web_dest, r=rate)
-            try:
-                stream = ffmpeg.run(stream, capture_stdout=True)
-                bowtiedb.add_asset(bowtiedb.Asset(source, variant, destination))
-            except:
-                logging.info("Unable to work on file?")
+    # Last change in bowtie_change that is on the pages, None until read
+    # from the journal
+    seq: Optional[int] = None
+    # Rendered atom <entry> elements by entry id, dropped when the entry
+    # changes so only new or edited entries are rendered on each build
+    feedFragments: Dict[int, Text] = field(default_factory=dict)
+
+def buildSignature() -> Text:
+    # Everything besides the entries that changes page bytes, pages built
+    # with a different signature are not trusted. Code changes still need
+    # "gen.py rebuild".
+    digest = hashlib.sha256()
+    digest.update(repr((TEMPLATE_BEGIN, TEMPLATE_END, NAV_BEGIN, NAV_END, ENTRIES_BEGIN, ENTRIES_END, site_url,
+        PAGE_BUDGET, BUILD_LIMIT, ANIMATION_MODE, VARIANT_ENCODING)).encode())
+    return digest.hexdigest()
+
+def sourceHash(source: Text) -> Text:
+    path = storage.downloadPath(source)
+    stat = os.stat(path)
+    key = (source, stat.st_mtime_ns, stat.st_size)
+    if not key in source_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(65536), b""):
+                digest.update(chunk)
+        source_hashes[key] = digest.hexdigest()
+    return source_hashes[key]
+
+def variantName(variant: Text, source: Text) -> Text:
+    # The same source bytes encoded the same way always get the same name,
+    # so a lost asset row never causes a second transcode
+    digest = hashlib.sha256()
+    digest.update(sourceHash(source).encode())
+    digest.update(variant.encode())
+    digest.update(repr(VARIANT_ENCODING[variant]).encode())
+    return storage.webName(digest.hexdigest()[:24] + VARIANT_EXTENSIONS[variant])
+
+def probeAnimation(path: Text, size: int) -> Tuple[int, int, float]:
+    import ffmpeg
+    stream = ffmpeg.probe(path)["streams"][0]
+    width = stream["width"]
+    height = stream["height"]
+    ratio = min(min(size, width) / width, min(size, height) / height)
+    return (int(ratio * width), int(ratio * height), float(stream["duration"]))
+
+def makeAsset(variant, source, destination) -> bool:
+    web_dest = storage.webPath(destination)
+    download_source = storage.downloadPath(source)
+    if os.path.exists(web_dest):
+        return True
+    storage.ensureDirectory(web_dest)
+    # Encode next to the destination and rename it into place, a reader
+    # never sees a partially written variant
+    (stem, extension) = os.path.splitext(web_dest)
+    tmp_dest = stem + "." + str(os.getpid()) + ".tmp" + extension
+    if variant == VARIANT_256 or variant == VARIANT_128:
+        result = subprocess.Popen(["convert", download_source] + VARIANT_ENCODING[variant] + [tmp_dest])
+        text = result.communicate()[0]
+        return_code = result.returncode
+        logging.info("Converted %s to %s: %s", source, destination, text)
+        if return_code != 0:
+            logging.warn("convert exited with code %d", return_code)
+            return False
+    elif variant == VARIANT_128GIF:
+        # ffmpeg is only needed for animations, import it when one shows up
+        import ffmpeg
+        encoding = VARIANT_ENCODING[variant]
+        (resized_width, resized_height, duration) = probeAnimation(download_source, encoding["size"])
+        stream = ffmpeg.input(download_source)
+
+        if duration > encoding["duration"]:
+            stream = ffmpeg.trim(stream, duration=encoding["duration"])
+        if duration > 2:
+            rate = int(max(min(encoding["frames"] / duration, encoding["rate"]), 1))
+        else:
+            rate = encoding["rate"]
+        stream = ffmpeg.filter(stream, 'scale', str(resized_width), str(resized_height))
+        stream = ffmpeg.output(stream, tmp_dest, r=rate)
+        try:
+            stream = ffmpeg.run(stream, capture_stdout=True, overwrite_output=True)
+        except:
+            logging.info("Unable to work on file?")
+            return False
+    elif variant == VARIANT_128POSTER:
+        import ffmpeg
+        encoding = VARIANT_ENCODING[variant]
+        (resized_width, resized_height, _) = probeAnimation(download_source, encoding["size"])
+        stream = ffmpeg.input(download_source)
+        stream = ffmpeg.filter(stream, 'scale', str(resized_width), str(resized_height))
+        stream = ffmpeg.output(stream, tmp_dest, vframes=encoding["frames"])
+        try:
+            ffmpeg.run(stream, capture_stdout=True, overwrite_output=True)
+        except:
+            logging.info("Unable to extract a poster from %s", source)
+            return False
+    else:
+        return False
+    os.replace(tmp_dest, web_dest)
+    return True
+
+def resolveVariant(source: Text, variant: Text) -> Optional[Text]:
+    asset = bowtiedb.find_asset(source, variant)
+    if asset and os.path.exists(storage.webPath(asset.destination)):
+        return asset.destination
+    if not os.path.exists(storage.downloadPath(source)):
+        logging.warning("Missing download %s", source)
+        return None
+    destination = variantName(variant, source)
+    if not makeAsset(variant, source, destination):
+        return None
+    # The asset table only caches the name, it can always be derived again
+    bowtiedb.add_asset(bowtiedb.Asset(source, variant, destination))
+    return destination
 
 
 # This is a highly inefficient algorithm
@@ -216,158 +303,362 @@ def makeHtml(content: Text, entities: List[bowtiedb.TelegramMessageEntity]) -> T
 
     return output
 
+def atomDate(date: int) -> Text:
+    return datetime.datetime.fromtimestamp(date, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def siteLink(path: Text) -> Text:
+    if site_url:
+        return site_url + "/" + path
+    return path
+
+def makeFeedEntry(entry: bowtiedb.Entry, web_photo: Optional[Text]) -> Text:
+    display_name = entry.display_name or 'Null'
+    content_html = ""
+    if web_photo:
+        content_html += '<img src="' + siteLink(web_photo) + '" alt=""><br>'
+    title = display_name
+    if entry.content:
+        content_html += makeHtml(entry.content, entry.entities or [])
+        title = entry.content.split("\n")[0][:80]
+    fragment = "<entry>\n"
+    fragment += "<id>urn:bowtie:entry:" + str(entry.identity) + "</id>\n"
+    fragment += "<title>" + html.escape(title) + "</title>\n"
+    fragment += "<author><name>" + html.escape(display_name) + "</name></author>\n"
+    fragment += "<updated>" + atomDate(entry.date) + "</updated>\n"
+    fragment += '<link rel="alternate" href="' + html.escape(siteLink("index.html")) + '"/>\n'
+    fragment += '<content type="html">' + html.escape(content_html) + "</content>\n"
+    fragment += "</entry>\n"
+    return fragment
+
+def writeFeed(state: State, feed_entries: List[bowtiedb.Entry]) -> None:
+    feed = FEED_BEGIN
+    if feed_entries:
+        feed += "<updated>" + atomDate(feed_entries[0].date) + "</updated>\n"
+    feed += '<link rel="self" href="' + html.escape(siteLink(FEED_FILENAME)) + '"/>\n'
+    feed += "".join([state.feedFragments[entry.identity] for entry in feed_entries])
+    feed += FEED_END
+    # Forget fragments that fell out of the feed
+    current = set([entry.identity for entry in feed_entries])
+    for identity in list(state.feedFragments.keys()):
+        if identity not in current:
+            del state.feedFragments[identity]
+    encoded = feed.encode("utf-8")
+    path = web_path + "/" + FEED_FILENAME
+    # Leave an unchanged feed alone so its validators stay the same
+    if os.path.exists(path):
+        with open(path, 'rb') as fh:
+            if fh.read() == encoded:
+                return
+    with open(path + ".tmp", 'wb') as fh:
+        fh.write(encoded)
+    os.replace(path + ".tmp", path)
+    logging.info("Wrote %s", FEED_FILENAME)
+
+@dataclass
+class RenderedEntry():
+    html: Text
+    icon: Optional[Text]
+    # Shown on the page and counted against its budget
+    photo: Optional[Text]
+    # Only linked from the page
+    animation: Optional[Text] = None
+
+def resolveIcon(icon: Text) -> Optional[Text]:
+    return resolveVariant(icon, VARIANT_128)
+
+# Commits on its own connection, the build's transaction stays open until
+# every page is written and would hold the write lock the workers need
 @bowtiedb.with_connection
-def build(state:State) -> None:
-    latest = getLatestEntry()
-    if latest is None:
-        return
-    if state.lastEntry and state.lastEntry.identity == latest.identity:
-        return
-    # A change has occurred!
-    state.lastEntry = latest
-    logging.info("Rebuilding")
-    entries = bowtiedb.find_entries(100)
+def resolveIcons(icons: Set[Text]) -> Dict[Text, Optional[Text]]:
+    return dict([(icon, resolveIcon(icon)) for icon in icons])
+
+def renderEntry(entry: bowtiedb.Entry, icons: Dict[Text, Text]) -> RenderedEntry:
+    photo = entry.photo
+    icon = entry.icon
+    web_photo = None
+    web_icon = None
+    web_animation = None
+    if photo:
+        variant = None
+        if photo.endswith(".webp"):
+            # Convert to jpg with background
+            variant=VARIANT_256
+        elif photo.endswith(".jpg") or photo.endswith(".png"):
+            # Resized
+            variant=VARIANT_256
+        elif photo.endswith(".mp4") or photo.endswith(".gif"):
+            # Resized and limited gif
+            variant=VARIANT_128GIF
+        if variant:
+            web_photo = resolveVariant(photo, variant)
+        if variant == VARIANT_128GIF and web_photo and ANIMATION_MODE == "poster":
+            poster = resolveVariant(photo, VARIANT_128POSTER)
+            if poster:
+                web_animation = web_photo
+                web_photo = poster
+    if icon and not (icon in icons):
+        web_icon = resolveIcon(icon)
+        icons[icon] = web_icon
+    elif icon in icons:
+        web_icon = icons[icon]
+    display_name = entry.display_name or 'Null'
+    entry_html = ""
+    entry_html += '<tr><td><font color="#deb836"><b>' + html.escape(display_name) + '</b></font></td>'
+    entry_html += '<td><font color="#f6f3ed"><i>' + str(datetime.datetime.fromtimestamp(entry.date)) + ' UTC</i></font></td></tr>\n'
+    entry_html += '<tr><td>'
+    if web_icon:
+        entry_html += '<img src="' + web_icon + '" alt="">'
+    entry_html += '</td><td valign="top">'
+    if web_animation:
+        entry_html += '<center><a href="' + web_animation + '"><img src="' + web_photo + '" alt="Play"></a><br></center>'
+    elif web_photo:
+        entry_html += '<center><img src="' + web_photo + '" alt=""><br></center>'
+    if entry.content:
+        entry_html += '<font color="#f6f3ed">'
+        entry_html += makeHtml(entry.content, entry.entities or [])
+        entry_html += '</font>'
+    entry_html += '</td></tr>\n'
+    return RenderedEntry(entry_html, web_icon, web_photo, web_animation)
+
+def renderSerial(entries: Iterator[bowtiedb.Entry]) -> Iterator[Tuple[bowtiedb.Entry, RenderedEntry]]:
     icons = {}
-    files = []
-    entry_htmls = []
-    file_sizes = dict()
+    for entry in entries:
+        yield (entry, renderEntry(entry, icons))
 
+def renderShard(entries: List[bowtiedb.Entry], icons: Dict[Text, Text]) -> List[RenderedEntry]:
+    # Runs in a worker process. No connection is held across the shard, each
+    # asset row commits on its own so the write lock is never held while
+    # another worker is encoding.
+    return [renderEntry(entry, icons) for entry in entries]
+
+def renderParallel(entries: Iterator[bowtiedb.Entry], workers: int) -> Iterator[Tuple[bowtiedb.Entry, RenderedEntry]]:
+    icons = {}
+    pending = collections.deque()
+    # Spawned workers do not inherit this process's open sqlite connection
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for shard in shardEntries(entries, SHARD_SIZE):
+            # The same icon shows up across shards, resolve it once here so
+            # workers never race to create the same asset
+            missing = set([entry.icon for entry in shard if entry.icon and not entry.icon in icons])
+            if missing:
+                icons.update(resolveIcons(missing))
+            shard_icons = dict([(entry.icon, icons[entry.icon]) for entry in shard if entry.icon])
+            pending.append((shard, pool.submit(renderShard, shard, shard_icons)))
+            # Bound the work in flight so memory does not grow with history
+            while len(pending) >= workers * 2:
+                (done_shard, future) = pending.popleft()
+                yield from zip(done_shard, future.result())
+        while pending:
+            (done_shard, future) = pending.popleft()
+            yield from zip(done_shard, future.result())
+
+def shardEntries(entries: Iterator[bowtiedb.Entry], size: int) -> Iterator[List[bowtiedb.Entry]]:
+    shard = []
     for entry in entries:
-        photo = entry.photo
-        icon = entry.icon
-        web_photo = None
-        web_icon = None
-        if photo:
-            variant = None
-            if photo.endswith(".webp"):
-                # Convert to jpg with background
-                variant=VARIANT_256
-            elif photo.endswith(".jpg") or photo.endswith(".png"):
-                # Resized
-                variant=VARIANT_256
-            elif photo.endswith(".mp4") or photo.endswith(".gif"):
-                # Resized and limited gif
-                variant=VARIANT_128GIF
-            asset = None
-            if variant:
-                asset = bowtiedb.find_asset(photo, variant)
-            source = None
-            destination = None
-            if not asset and variant:
-                if variant == VARIANT_256:
-                    destination = str(uuid.uuid4())[24:] + ".jpg"
-                    source = photo
-                elif variant == VARIANT_128GIF:
-                    destination = str(uuid.uuid4())[24:] + ".gif"
-                    source = photo
-            elif asset:
-                destination = asset.destination
-                source = asset.source
-            if variant and destination and source:
-                # Check and see if we need to create this
-                makeAsset(variant, source, destination)
-                web_photo = destination
-        if icon and not (icon in icons):
-            variant = VARIANT_128
-            source = icon
-            asset = bowtiedb.find_asset(source, variant)
-            if not asset:
-                destination = str(uuid.uuid4())[24:] + ".jpg"
-            else:
-                destination = asset.destination
-            makeAsset(variant, source, destination)
-            web_icon = destination
-            icons[icon] = destination
-        elif icon in icons:
-            web_icon = icons[icon]
-        display_name = entry.display_name or 'Null'
-        entry_html = ""
-        entry_html += '<tr><td><font color="#deb836"><b>' + html.escape(display_name) + '</b></font></td>'
-        entry_html += '<td><font color="#f6f3ed"><i>' + str(datetime.datetime.fromtimestamp(entry.date)) + ' UTC</i></font></td></tr>\n'
-        entry_html += '<tr><td>'
-        if web_icon:
-            entry_html += '<img src="' + web_icon + '" alt="">'
-            files.append(web_icon)
-            if not web_icon in file_sizes:
-                file_sizes[web_icon] = os.stat(web_path + "/" + web_icon).st_size
-        entry_html += '</td><td valign="top">'
-        if web_photo:
-            entry_html += '<center><img src="' + web_photo + '" alt=""><br></center>'
-            files.append(web_photo)
-            if not web_photo in file_sizes:
-                file_sizes[web_photo] = os.stat(web_path + "/" + web_photo).st_size
-        if entry.content:
-            entry_html += '<font color="#f6f3ed">'
-            entry_html += makeHtml(entry.content, entry.entities or [])
-            entry_html += '</font>'
-        entry_html += '</td></tr>\n'
-        entry_htmls.append({
-            "html": entry_html,
-            "icon": web_icon,
-            "photo": web_photo
-        })
-    budget = PAGE_BUDGET
-    page_num = 0
-    page_entries = dict()
-    page_entries[0] = dict()
-    page_entries[0]["entries"] = []
-    page_entries[0]["files"] = set()
-    for entry in entry_htmls:
-        size = len(entry["html"])
-        if entry["icon"] and not entry["icon"] in page_entries[page_num]["files"]:
-            size += file_sizes[entry["icon"]]
-        if entry["photo"] and not entry["photo"] in page_entries[page_num]["files"]:
-            size += file_sizes[entry["photo"]]
-        budget -= size
-        if (budget < 0 and len(page_entries[page_num]["entries"]) > 0) or len(page_entries[page_num]["entries"]) > 9:
-            budget = PAGE_BUDGET - len(entry["html"])
-            page_num += 1
-            page_entries[page_num] = dict()
-            page_entries[page_num]["entries"] = [entry["html"]]
-            page_entries[page_num]["files"] = set()
-            files_set: set = page_entries[page_num]["files"]
-            if entry["icon"]:
-                files_set.add(entry["icon"])
-                budget -= file_sizes[entry["icon"]]
-            if entry["photo"]:
-                files_set.add(entry["photo"])
-                budget -= file_sizes[entry["photo"]]
+        shard.append(entry)
+        if len(shard) >= size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+class PagePacker():
+    # Packs rendered entries into pages in a single pass. Entry html goes
+    # straight to the body file, only the byte offset where each page ends
+    # is remembered.
+    def __init__(self, body: BinaryIO):
+        self.body = body
+        self.budget = PAGE_BUDGET
+        self.files: Set[Text] = set()
+        self.count = 0
+        self.page_ends: List[int] = []
+        self.file_sizes: Dict[Text, int] = dict()
+
+    def fileSize(self, name: Text) -> int:
+        if not name in self.file_sizes:
+            self.file_sizes[name] = os.stat(storage.webPath(name)).st_size
+        return self.file_sizes[name]
+
+    def add(self, rendered: RenderedEntry) -> None:
+        size = len(rendered.html)
+        if rendered.icon and not rendered.icon in self.files:
+            size += self.fileSize(rendered.icon)
+        if rendered.photo and not rendered.photo in self.files:
+            size += self.fileSize(rendered.photo)
+        self.budget -= size
+        if (self.budget < 0 and self.count > 0) or self.count > 9:
+            self.page_ends.append(self.body.tell())
+            self.budget = PAGE_BUDGET - len(rendered.html)
+            self.files = set()
+            self.count = 0
+            if rendered.icon:
+                self.budget -= self.fileSize(rendered.icon)
+            if rendered.photo:
+                self.budget -= self.fileSize(rendered.photo)
+        if rendered.icon:
+            self.files.add(rendered.icon)
+        if rendered.photo:
+            self.files.add(rendered.photo)
+        self.count += 1
+        self.body.write(rendered.html.encode("iso-8859-1", 'ignore'))
+
+    def finish(self) -> List[int]:
+        self.page_ends.append(self.body.tell())
+        return self.page_ends
+
+def pageFilename(page: int) -> Text:
+    if page == 0:
+        return "index.html"
+    return "page" + str(page) + ".html"
+
+def makeNav(page: int, page_count: int) -> bytes:
+    nav_html = NAV_BEGIN
+    nav_html += '<td align="left">'
+    if page == 1:
+        nav_html += '<a href="index.html"><font color="#f7b2a9">First Page</font></a>'
+    elif page > 1:
+        nav_html += '<a href="page' + str(page - 1) + '.html"><font color="#f7b2a9">Previous Page</font></a>'
+    nav_html += '</td><td align="right">'
+    if page_count > page + 2:
+        nav_html += '<a href="page' + str(page + 1) + '.html"><font color="#f7b2a9">Next Page</font></a>'
+    elif page_count > page + 1:
+        nav_html += '<a href="page' + str(page + 1) + '.html"><font color="#f7b2a9">Last Page</font></a>'
+    nav_html += '</td>' + NAV_END
+    return nav_html.encode("iso-8859-1", 'ignore')
+
+def pageChunks(page: int, page_count: int, body: BinaryIO, start: int, end: int) -> Iterator[bytes]:
+    nav = makeNav(page, page_count)
+    yield PAGE_BEGIN_BYTES
+    yield nav
+    yield ENTRIES_BEGIN_BYTES
+    body.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = body.read(min(remaining, 65536))
+        if not chunk:
+            break
+        yield chunk
+        remaining -= len(chunk)
+    yield ENTRIES_END_BYTES
+    yield nav
+    yield TEMPLATE_END_BYTES
+
+def pageHash(page: int, page_count: int, body: BinaryIO, start: int, end: int) -> Text:
+    digest = hashlib.sha256()
+    for chunk in pageChunks(page, page_count, body, start, end):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def writePage(page: int, page_count: int, body: BinaryIO, start: int, end: int) -> Text:
+    filename = pageFilename(page)
+    path = web_path + "/" + filename
+    # Write beside the page and rename over it so readers never see half a page
+    with open(path + ".tmp", 'wb') as fh:
+        for chunk in pageChunks(page, page_count, body, start, end):
+            fh.write(chunk)
+    os.replace(path + ".tmp", path)
+    logging.info("Wrote %s", filename)
+    return filename
+
+def invalidateBuild() -> None:
+    # The next build, here or in a running generator, renders every page
+    bowtiedb.delete_configs([BUILD_SEQ, BUILD_SIGNATURE])
+
+def pagesPresent() -> bool:
+    # The database can outlive the web volume, or the pages can be wiped
+    page_hashes = bowtiedb.find_page_hashes()
+    if pageFilename(0) not in page_hashes:
+        return False
+    return all([os.path.exists(web_path + "/" + filename) for filename in page_hashes])
+
+@bowtiedb.with_connection
+def build(state:State, workers:Optional[int]=None, force:bool=False) -> None:
+    # Entry writes are journaled in bowtie_change. The last change built and
+    # the hash of every page written are kept in the database, so a restart
+    # with nothing new to build does nothing and only pages whose bytes
+    # changed are written.
+    seq = bowtiedb.latest_change()
+    signature = buildSignature()
+    full_rebuild = False
+    if state.seq is not None and bowtiedb.read_config(BUILD_SEQ) is None:
+        # Invalidated since the last build
+        state.seq = None
+    if state.seq is None:
+        built = bowtiedb.read_config(BUILD_SEQ)
+        if built is not None and bowtiedb.read_config(BUILD_SIGNATURE) == signature and pagesPresent():
+            state.seq = int(built)
         else:
-            page_entries[page_num]["entries"].append(entry["html"])
-            files_set: set = page_entries[page_num]["files"]
-            if entry["icon"]:
-                files_set.add(entry["icon"])
-            if entry["photo"]:
-                files_set.add(entry["photo"])
-
-    for page in page_entries:
-        filename = "page" + str(page) + ".html"
-        if page == 0:
-            filename = "index.html"
-        page_html = TEMPLATE_BEGIN
-        nav_html = NAV_BEGIN
-        nav_html += '<td align="left">'
-        if page == 1:
-            nav_html += '<a href="index.html"><font color="#f7b2a9">First Page</font></a>'
-        elif page > 1:
-            nav_html += '<a href="page' + str(page - 1) + '.html"><font color="#f7b2a9">Previous Page</font></a>'
-        nav_html += '</td><td align="right">'
-        if len(page_entries) > page + 2:
-            nav_html += '<a href="page' + str(page + 1) + '.html"><font color="#f7b2a9">Next Page</font></a>'
-        elif len(page_entries) > page + 1:
-            nav_html += '<a href="page' + str(page + 1) + '.html"><font color="#f7b2a9">Last Page</font></a>'
-        nav_html += '</td>' + NAV_END
-        page_html += nav_html + ENTRIES_BEGIN
-        page_html += "".join(page_entries[page]["entries"]) + ENTRIES_END
-        page_html += nav_html + TEMPLATE_END
-        with open(web_path + "/" + filename, 'wb') as fh:
-            fh.write(page_html.encode("iso-8859-1", 'ignore'))
-            logging.info("Wrote %s", filename)
-            files.append(filename)
+            full_rebuild = True
+            state.feedFragments.clear()
+    if not force and not full_rebuild and state.seq == seq:
+        return
+    # A change has occurred!
+    if state.seq is not None:
+        for identity in bowtiedb.find_changed_entries(state.seq):
+            state.feedFragments.pop(identity, None)
+    logging.info("Rebuilding")
+    files = set()
+    feed_entries = []
+    if workers is None:
+        # Nothing trustworthy has been built yet, expect every page and
+        # possibly every variant to need regenerating
+        workers = BUILD_WORKERS if full_rebuild else 1
+    if workers > 1:
+        rendered_entries = renderParallel(bowtiedb.iter_entries(BUILD_LIMIT), workers)
+    else:
+        rendered_entries = renderSerial(bowtiedb.iter_entries(BUILD_LIMIT))
+
+    with tempfile.SpooledTemporaryFile(max_size=PAGE_BUDGET * 4) as body:
+        packer = PagePacker(body)
+        for (entry, rendered) in rendered_entries:
+            packer.add(rendered)
+            if rendered.icon:
+                files.add(rendered.icon)
+            if rendered.photo:
+                files.add(rendered.photo)
+            if rendered.animation:
+                files.add(rendered.animation)
+            if len(feed_entries) < FEED_SIZE:
+                if entry.identity not in state.feedFragments:
+                    # Feed readers fetch images on their own, give them the animation
+                    state.feedFragments[entry.identity] = makeFeedEntry(entry, rendered.animation or rendered.photo)
+                feed_entries.append(entry)
+        page_ends = packer.finish()
+
+        page_hashes = bowtiedb.find_page_hashes()
+        written = dict()
+        start = 0
+        for page in range(len(page_ends)):
+            filename = pageFilename(page)
+            page_hash = pageHash(page, len(page_ends), body, start, page_ends[page])
+            if force or page_hashes.get(filename) != page_hash or not os.path.exists(web_path + "/" + filename):
+                files.add(writePage(page, len(page_ends), body, start, page_ends[page]))
+                written[filename] = page_hash
+            start = page_ends[page]
+
+    # Pages past the end are no longer linked from anywhere
+    current = set([pageFilename(page) for page in range(len(page_ends))])
+    for filename in page_hashes:
+        if filename not in current:
+            if os.path.exists(web_path + "/" + filename):
+                os.remove(web_path + "/" + filename)
+                logging.info("Removed %s", filename)
+            bowtiedb.delete_page_hash(filename)
+
+    writeFeed(state, feed_entries)
+    files.add(FEED_FILENAME)
+
+    # Committed with the rest of this transaction once every page is on disk,
+    # a crash before that only repeats the build
+    bowtiedb.set_page_hashes(written)
+    bowtiedb.set_configs({BUILD_SEQ: str(seq), BUILD_SIGNATURE: signature})
+    bowtiedb.delete_changes(seq)
+    state.seq = seq
 
     # Remote upload to bowtie is currently disabled
     # Unfortunately the host is down and may not return.
     # if sftp_host and len(sftp_host) > 0 and sftp_pass and sftp_user and sftp_path:
+    #     import pysftp
     #     cnopts = pysftp.CnOpts()
     #     cnopts.hostkeys = None
     #     with pysftp.Connection(sftp_host, username=sftp_user, password=sftp_pass, cnopts=cnopts) as sftp:
@@ -390,19 +681,24 @@ def build(state:State) -> None:
 
 
 
-def main() -> None:
+def setup() -> None:
     logging.info("Init")
     bowtiedb.init()
 
     # Copy all static content into the web serving path upon startup
 
     try:
-        dir_util.copy_tree("./static/", web_path)
+        shutil.copytree("./static/", web_path, dirs_exist_ok=True)
     except Exception as e:
         logging.error("An error!", e)
-    
 
+def main() -> None:
+    setup()
     state = State()
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+        # One full rebuild across all cores, then exit
+        build(state, BUILD_WORKERS, force=True)
+        return
     while True:
         time.sleep(1)
         try:
@@ -8,4 +8,8 @@ fi
 mkdir -p "$DOWNLOADS_PATH"
 mkdir -p "$WEB_PATH"
 
+if [[ "$UNIFIED_RUNTIME" == "1" ]]; then
+    exec python3 runtime.py
+fi
+
 supervisord -n
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os
+import signal
+import asyncio
+import logging
+from typing import List, Text
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import bowtiedb
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+load_dotenv()
+
+# Runs the bot, the twitter poller, the generator and the web server in one
+# process instead of four supervisord programs.
+SERVICES = [service.strip() for service in os.getenv("RUNTIME_SERVICES", "bot,twitter,gen,web").split(",") if service.strip()]
+POOL_SIZE = int(os.getenv("RUNTIME_POOL_SIZE", "4"))
+WORKERS = int(os.getenv("RUNTIME_WORKERS", "8"))
+# Entries written by other processes (imports, tools) are only noticed by polling
+GEN_FALLBACK_INTERVAL = 30
+
+async def runGen(rebuild: asyncio.Event) -> None:
+    import gen
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, gen.setup)
+    state = gen.State()
+    while True:
+        try:
+            await loop.run_in_executor(None, gen.build, state)
+        except Exception as e:
+            logging.error("Build failed: %s", e)
+        try:
+            await asyncio.wait_for(rebuild.wait(), GEN_FALLBACK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        rebuild.clear()
+
+async def runTwitter() -> None:
+    import twitter
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            user = await loop.run_in_executor(None, twitter.api.verify_credentials)
+            logging.info("Twitter authentication OK")
+            break
+        except Exception as e:
+            logging.error("Twitter authentication failed: %s", e)
+            await asyncio.sleep(300)
+    while True:
+        try:
+            await loop.run_in_executor(None, twitter.poll, user)
+        except Exception as e:
+            logging.error("Twitter poll failed: %s", e)
+        await asyncio.sleep(twitter.POLL_INTERVAL)
+
+async def runBot() -> None:
+    import bot
+    loop = asyncio.get_running_loop()
+    updater = await loop.run_in_executor(None, bot.createUpdater)
+    # The updater polls or listens for telegram from its own threads
+    server = await loop.run_in_executor(None, bot.startBot, updater)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await loop.run_in_executor(None, bot.stopBot, updater, server)
+
+async def runWeb() -> None:
+    import web
+    loop = asyncio.get_running_loop()
+    server = web.createServer()
+    logging.info("Serving %s on port %d", web.web_path, web.port)
+    try:
+        await loop.run_in_executor(None, server.serve_forever)
+    finally:
+        await loop.run_in_executor(None, server.shutdown)
+
+async def run(services: List[Text]) -> None:
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=WORKERS))
+    bowtiedb.enable_pool(POOL_SIZE)
+    await loop.run_in_executor(None, bowtiedb.init)
+
+    # Wake the generator as soon as an entry is committed in this process
+    rebuild = asyncio.Event()
+    bowtiedb.add_entry_listener(lambda: loop.call_soon_threadsafe(rebuild.set))
+
+    tasks = []
+    if "gen" in services:
+        tasks.append(asyncio.create_task(runGen(rebuild)))
+    if "web" in services:
+        tasks.append(asyncio.create_task(runWeb()))
+    if "bot" in services:
+        tasks.append(asyncio.create_task(runBot()))
+    if "twitter" in services:
+        tasks.append(asyncio.create_task(runTwitter()))
+    logging.info("Running %s", ", ".join(services))
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    stopping = asyncio.create_task(stop.wait())
+    done, _ = await asyncio.wait(tasks + [stopping], return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        if task is not stopping and task.exception():
+            logging.error("Service stopped: %s", task.exception())
+    logging.info("Shutting down")
+    for task in tasks + [stopping]:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def main() -> None:
+    asyncio.run(run(SERVICES))
+
+if __name__ == '__main__':
+    main()
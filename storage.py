@@ -0,0 +1,87 @@
+import os
+import sys
+import hashlib
+import logging
+from typing import Text
+from dotenv import load_dotenv
+import bowtiedb
+
+load_dotenv()
+
+downloads_path = os.environ["DOWNLOADS_PATH"]
+web_path = os.environ["WEB_PATH"]
+
+# Files fan out into 256 subdirectories named after a hash of the file
+# name, so no single directory grows with the whole history.
+def shard(name: Text) -> Text:
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:2]
+
+def downloadPath(name: Text) -> Text:
+    # Downloads are referred to by plain name, the shard is derived
+    path = downloads_path + "/" + shard(name) + "/" + name
+    if not os.path.exists(path):
+        legacy = downloads_path + "/" + name
+        if os.path.exists(legacy):
+            # Not migrated yet
+            return legacy
+    return path
+
+def webName(name: Text) -> Text:
+    # Variants are referred to by their path relative to the web root,
+    # which is also their url relative to the pages
+    return shard(name) + "/" + name
+
+def webPath(destination: Text) -> Text:
+    return web_path + "/" + destination
+
+def ensureDirectory(path: Text) -> None:
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+def migrateDownloads() -> int:
+    moved = 0
+    for entry in os.scandir(downloads_path):
+        if not entry.is_file():
+            continue
+        path = downloads_path + "/" + shard(entry.name) + "/" + entry.name
+        ensureDirectory(path)
+        os.replace(entry.path, path)
+        moved += 1
+    return moved
+
+@bowtiedb.with_connection
+def migrateWeb() -> int:
+    import gen
+    moved = 0
+    for asset in bowtiedb.find_assets():
+        if "/" in asset.destination:
+            continue
+        destination = webName(asset.destination)
+        if os.path.exists(webPath(asset.destination)) and not os.path.exists(webPath(destination)):
+            ensureDirectory(webPath(destination))
+            # Link rather than move, pages built before the migration keep
+            # working until the next build. Both names share the inode, touch
+            # it so cleanup.py gives the old name its full retention period.
+            os.link(webPath(asset.destination), webPath(destination))
+            os.utime(webPath(destination))
+        bowtiedb.add_asset(bowtiedb.Asset(asset.source, asset.variant, destination, asset.identity))
+        moved += 1
+    if moved:
+        # No entry changed, so the journal alone would leave the pages
+        # linking to the old names until something else is posted
+        gen.invalidateBuild()
+    return moved
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: storage.py migrate")
+        sys.exit(2)
+    bowtiedb.init()
+    logging.info("Moved %d downloads into shards", migrateDownloads())
+    logging.info("Linked %d variants into shards", migrateWeb())
+
+if __name__ == '__main__':
+    main()
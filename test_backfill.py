@@ -0,0 +1,93 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+from typing import Dict, List, Text
+
+from bench_ingest import FakeUpstream, makeStatus, setupEnvironment
+
+# bench_ingest already configured logging for its quieter report
+logging.getLogger().setLevel(logging.INFO)
+
+# Runs the twitter backfill against the fake timeline API in bench_ingest.
+# The first run pages back with max_id, is answered with a 429 without
+# rate limit headers, one with them and then a server error that ends it.
+# The second run has to resume from the saved checkpoint and finish, with
+# a tweet whose media is gone stored without it.
+TWEETS = 450
+PAGE_SIZE = 200
+NEWEST = 1449
+MISSING_MEDIA = 1100
+BACKOFF = 0.5
+
+def makeTimeline() -> List[Dict]:
+    timeline = []
+    for identity in range(NEWEST, NEWEST - TWEETS, -1):
+        status = makeStatus("backfill %d" % identity, identity)
+        if identity == MISSING_MEDIA:
+            status["extended_entities"]["media"][0]["media_url"] = "http://pbs.twimg.com/media/missing%d.jpg" % identity
+        timeline.append(status)
+    return timeline
+
+def expect(what: Text, actual, expected) -> None:
+    if actual != expected:
+        raise AssertionError("%s: expected %r, got %r" % (what, expected, actual))
+    logging.info("%s: %r", what, actual)
+
+def run(workdir: Text) -> None:
+    upstream = FakeUpstream(None, makeTimeline())
+    threading.Thread(target=upstream.serve_forever, name="upstream", daemon=True).start()
+    setupEnvironment(workdir, upstream)
+    # The second page is refused three times
+    upstream.timeline_failures[2] = (429, {})
+    upstream.timeline_failures[4] = (500, {})
+
+    import time
+    import tweepy
+    import bowtiedb
+    import twitter
+    twitter.BACKFILL_PAGE_SIZE = PAGE_SIZE
+    twitter.BACKOFF_INITIAL = BACKOFF
+    bowtiedb.init()
+    try:
+        user = twitter.api.verify_credentials()
+        expect("user", user.id, 7)
+        # The reset is only known once the third request is made
+        upstream.timeline_failures[3] = (429, {"x-rate-limit-remaining": "0", "x-rate-limit-reset": str(int(time.time()) + 2)})
+        try:
+            twitter.backfill(user)
+            raise AssertionError("The first backfill should have ended on the server error")
+        except tweepy.TwitterServerError:
+            pass
+        expect("checkpoint after the first run", bowtiedb.read_config(twitter.BACKFILL_CHECKPOINT), str(NEWEST - PAGE_SIZE))
+        expect("tweets after the first run", len(bowtiedb.find_tweet_ids(list(range(NEWEST - TWEETS, NEWEST + 1)))), PAGE_SIZE)
+        requests = upstream.timeline_requests
+        expect("backed off without headers", requests[2][1] - requests[1][1] >= BACKOFF, True)
+        expect("waited for the reset", requests[3][1] - requests[2][1] >= 1, True)
+
+        twitter.backfill(user)
+        expect("max_id of each request", [params.get("max_id") for (params, _) in upstream.timeline_requests],
+            [None] + [str(NEWEST - PAGE_SIZE)] * 4 + [str(NEWEST - 2 * PAGE_SIZE), str(NEWEST - TWEETS)])
+        expect("checkpoint after the second run", bowtiedb.read_config(twitter.BACKFILL_CHECKPOINT), twitter.BACKFILL_DONE)
+        twitter.backfill(user)
+        expect("requests once complete", len(upstream.timeline_requests), 7)
+    finally:
+        upstream.shutdown()
+
+    entries = dict([(entry.content, entry) for entry in bowtiedb.find_entries(limit=TWEETS * 2)])
+    expect("entries", len(entries), TWEETS)
+    expect("tweets", len(bowtiedb.find_tweet_ids(list(range(NEWEST - TWEETS, NEWEST + 1)))), TWEETS)
+    expect("entry without its missing media", entries["backfill %d" % MISSING_MEDIA].photo, None)
+    expect("entries with media", len([entry for entry in entries.values() if entry.photo]), TWEETS - 1)
+
+def test_backfill() -> None:
+    workdir = tempfile.mkdtemp(prefix="test_backfill.")
+    try:
+        run(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    test_backfill()
+    logging.info("Twitter backfill works")
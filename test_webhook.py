@@ -0,0 +1,129 @@
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Text
+
+from bench_ingest import FakeUpstream, setupEnvironment
+
+# bench_ingest already configured logging for its quieter report
+logging.getLogger().setLevel(logging.INFO)
+
+# Starts bot.py in webhook mode against the fake Bot API from bench_ingest,
+# posts the recorded updates in testdata/webhook to its listener and stops
+# it with SIGTERM. Every update acknowledged before the signal has to end up
+# stored, and requests with the wrong secret or path must be refused.
+RECORDED_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "webhook")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = "webhook-test-secret"
+START_TIMEOUT = 60
+STOP_TIMEOUT = 60
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def loadUpdates() -> List[Dict]:
+    updates = []
+    for path in sorted(glob.glob(os.path.join(RECORDED_UPDATES, "*.json"))):
+        with open(path, 'rb') as fh:
+            updates.append(json.load(fh))
+    return updates
+
+def updateText(update: Dict) -> Text:
+    message = update["message"]
+    return message.get("text") or message.get("caption")
+
+def post(url: Text, update: Dict, secret: Optional[Text]) -> int:
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def waitForListener(port: int, bot: subprocess.Popen) -> None:
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            raise AssertionError("bot.py exited with code %d before listening" % bot.returncode)
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise AssertionError("bot.py did not listen within %d seconds" % START_TIMEOUT)
+
+def expect(what: Text, actual, expected) -> None:
+    if actual != expected:
+        raise AssertionError("%s: expected %r, got %r" % (what, expected, actual))
+    logging.info("%s: %r", what, actual)
+
+def run(workdir: Text) -> None:
+    upstream = FakeUpstream(None)
+    threading.Thread(target=upstream.serve_forever, name="upstream", daemon=True).start()
+    setupEnvironment(workdir, upstream)
+    port = freePort()
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["WEBHOOK_URL"] = ""
+    os.environ["WEBHOOK_LISTEN"] = "127.0.0.1"
+    os.environ["WEBHOOK_PORT"] = str(port)
+    os.environ["WEBHOOK_PATH"] = WEBHOOK_PATH
+    os.environ["WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    url = "http://127.0.0.1:%d" % port
+    updates = loadUpdates()
+    if not updates:
+        raise AssertionError("No recorded updates in " + RECORDED_UPDATES)
+    rejected = dict(updates[0], update_id=updates[0]["update_id"] + 1000,
+        message=dict(updates[0]["message"], text="webhook rejected entry"))
+
+    import bowtiedb
+    bowtiedb.init()
+    bot = subprocess.Popen([sys.executable, "bot.py"], cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        waitForListener(port, bot)
+        expect("wrong path", post(url + "/elsewhere", rejected, WEBHOOK_SECRET), 404)
+        expect("wrong secret", post(url + WEBHOOK_PATH, rejected, "not-the-secret"), 403)
+        expect("missing secret", post(url + WEBHOOK_PATH, rejected, None), 403)
+        for update in updates:
+            expect("update %d" % update["update_id"], post(url + WEBHOOK_PATH, update, WEBHOOK_SECRET), 200)
+        # Stop right away, updates still queued have to be handled first
+        bot.send_signal(signal.SIGTERM)
+        expect("exit code", bot.wait(STOP_TIMEOUT), 0)
+    finally:
+        if bot.poll() is None:
+            bot.kill()
+        upstream.shutdown()
+
+    stored = dict([(entry.content, entry) for entry in bowtiedb.find_entries(limit=100)])
+    for update in updates:
+        expect("stored %d" % update["update_id"], updateText(update) in stored, True)
+        if "photo" in update["message"]:
+            expect("photo downloaded %d" % update["update_id"], stored[updateText(update)].photo is not None, True)
+    expect("rejected entry stored", updateText(rejected) in stored, False)
+    expect("entry count", len(stored), len(updates))
+
+def test_webhook() -> None:
+    workdir = tempfile.mkdtemp(prefix="test_webhook.")
+    try:
+        run(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    test_webhook()
+    logging.info("Webhook ingestion works")
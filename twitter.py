@@ -1,13 +1,18 @@
 import os
+import sys
 import json
 import time
 import logging
 import datetime
+import urllib.parse
 import urllib.request
+import requests.adapters
 from typing import List, Optional, Text
+from dataclasses import dataclass
 import tweepy
 import tweepy.models
 import bowtiedb
+import storage
 
 from dotenv import load_dotenv
 
@@ -16,12 +21,43 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-downloads_path = os.environ["DOWNLOADS_PATH"]
+# Keep only TWEET_FIELDS and USER_FIELDS of each stored tweet, payloads are
+# compressed either way
+trim_json = os.getenv("TWEET_TRIM_JSON", "") == "1"
+POLL_INTERVAL = 60
+BACKFILL_PAGE_SIZE = 200
+BACKFILL_CHECKPOINT = "twitter_backfill_max_id"
+BACKFILL_DONE = "done"
+# Waits after a 429 that names no reset still ahead, doubled each time
+BACKOFF_INITIAL = 60
+BACKOFF_MAX = 15 * 60
+TWIMG_URL = "http://pbs.twimg.com/"
+# Point the API and media downloads elsewhere, such as a local fake
+api_url = os.getenv("TWITTER_API_URL", "").rstrip("/")
+media_url = os.getenv("TWITTER_MEDIA_URL", "").rstrip("/")
+# Fields of a status and its author that are worth keeping around
+TWEET_FIELDS = ["id", "id_str", "created_at", "full_text", "text", "display_text_range", "entities", "extended_entities",
+    "in_reply_to_status_id", "in_reply_to_screen_name", "lang"]
+USER_FIELDS = ["id", "id_str", "name", "screen_name", "profile_image_url", "profile_image_url_https"]
 
 auth = tweepy.OAuthHandler(os.environ["TWITTER_KEY"], os.environ["TWITTER_SECRET"])
 auth.set_access_token(os.environ["TWITTER_ACCESS_TOKEN"], os.environ["TWITTER_ACCESS_TOKEN_SECRET"])
 api = tweepy.API(auth)
 
+class RedirectAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, base_url: Text):
+        super().__init__()
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        request.url = self.base_url + url.path + ("?" + url.query if url.query else "")
+        return super().send(request, **kwargs)
+
+if api_url:
+    # tweepy always builds https://api.twitter.com urls, rewrite them
+    api.session.mount("https://" + api.host + "/", RedirectAdapter(api_url))
+
 # print("key %s", os.environ["TWITTER_KEY"])
 # print("secret %s", os.environ["TWITTER_SECRET"])
 # print("access %s", os.environ["TWITTER_ACCESS_TOKEN"])
@@ -30,50 +66,177 @@ api = tweepy.API(auth)
 # test authentication
 
 
+def trimTweet(data: dict) -> dict:
+    trimmed = dict([(key, data[key]) for key in TWEET_FIELDS if key in data])
+    if "user" in data and data["user"]:
+        trimmed["user"] = dict([(key, data["user"][key]) for key in USER_FIELDS if key in data["user"]])
+    return trimmed
+
+@dataclass
+class PreparedTweet():
+    identity: int
+    json: Text
+    entry: bowtiedb.Entry
+
+def mediaUrl(url: Text) -> Text:
+    if media_url and url.startswith(TWIMG_URL):
+        return media_url + "/" + url[len(TWIMG_URL):]
+    return url
+
+def downloadMedia(identity: int, url: Text) -> Optional[Text]:
+    name = url.replace(TWIMG_URL, "").replace("/", "_")
+    path = storage.downloadPath(name)
+    if os.path.exists(path):
+        return name
+    try:
+        with urllib.request.urlopen(mediaUrl(url)) as f:
+            data = f.read()
+    except Exception as e:
+        # Media of old tweets can be gone or withheld, the tweet is kept
+        # without it rather than failing its whole page forever
+        logging.warning("Unable to download %s for tweet %d: %s", url, identity, e)
+        return None
+    storage.ensureDirectory(path)
+    with open(path, 'wb') as fh:
+        fh.write(data)
+    logging.info("Wrote %s", name)
+    return name
+
+def prepareStatus(status: tweepy.models.Status) -> PreparedTweet:
+    # Downloads media and builds the rows for a status, without touching
+    # the database so no transaction is held open during network requests
+    created_at: datetime.datetime = status.created_at
+    created_at_unixtime = int(time.mktime(created_at.timetuple()))
+    text:Text = status.full_text
+    if status.display_text_range:
+        text = text[status.display_text_range[0]:status.display_text_range[1]]
+    author:tweepy.models.User = status.author
+    author_name = author.screen_name
+    profile_image:Optional[Text] = None
+    if hasattr(author, 'profile_image_url'):
+        profile_image = author.profile_image_url
+        profile_image = profile_image.replace("_normal", "")
+    photo_url = None
+    if hasattr(status, 'extended_entities'):
+        extended_entities:dict = status.extended_entities
+        if extended_entities and extended_entities["media"] and len(extended_entities["media"]) > 0 and extended_entities["media"][0]["media_url"]:
+            photo_url = extended_entities["media"][0]["media_url"]
+    download_profile_image = None
+    if profile_image:
+        download_profile_image = downloadMedia(status.id, profile_image)
+    download_photo_url = None
+    if photo_url:
+        download_photo_url = downloadMedia(status.id, photo_url)
+    tweet_json = status._json
+    if trim_json:
+        tweet_json = trimTweet(tweet_json)
+    print(author_name, download_profile_image, created_at_unixtime, text, download_photo_url)
+    entry = bowtiedb.Entry(created_at_unixtime, text, download_photo_url, [], author_name, download_profile_image)
+    return PreparedTweet(status.id, json.dumps(tweet_json), entry)
+
 @bowtiedb.with_connection
-def handleTimeline(timeline: List[tweepy.models.Status]) -> None:
+def saveTweets(prepared: List[PreparedTweet]) -> int:
+    # One transaction for the whole batch, tweets stored by another process
+    # since they were checked get no second entry
+    saved = bowtiedb.save_tweets([(tweet.identity, tweet.json) for tweet in prepared])
+    bowtiedb.add_entries([tweet.entry for tweet in prepared if tweet.identity in saved])
+    return len(saved)
+
+def handleTimeline(timeline: List[tweepy.models.Status]) -> int:
+    statuses = []
     for status in timeline:
         if hasattr(status, 'retweeted_status'):
             status = status.retweeted_status
-        if bowtiedb.has_tweet(status.id):
+        statuses.append(status)
+    seen = bowtiedb.find_tweet_ids([status.id for status in statuses])
+    prepared = []
+    for status in statuses:
+        if status.id in seen:
+            continue
+        seen.add(status.id)
+        prepared.append(prepareStatus(status))
+    if not prepared:
+        return 0
+    return saveTweets(prepared)
+
+class RateLimitScheduler():
+    # Spreads requests over what is left of the current rate limit window
+    # instead of sleeping a fixed amount between them
+    def __init__(self):
+        self.remaining: Optional[int] = None
+        self.reset: Optional[float] = None
+        # 429 responses since the last accepted request
+        self.rejections = 0
+
+    def update(self, headers) -> None:
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        if remaining is not None and reset is not None:
+            self.remaining = int(remaining)
+            self.reset = float(reset)
+
+    def accepted(self, headers) -> None:
+        self.update(headers)
+        self.rejections = 0
+
+    def rejected(self, headers) -> None:
+        self.update(headers)
+        self.rejections += 1
+
+    def delay(self) -> float:
+        window = None
+        if self.reset is not None:
+            window = max(self.reset - time.time(), 0)
+        if self.rejections > 0:
+            if window:
+                return window + 1
+            # Nothing to wait for according to the headers, back off instead
+            # of asking again right away
+            return min(BACKOFF_INITIAL * 2 ** (self.rejections - 1), BACKOFF_MAX)
+        if self.remaining is None or window is None:
+            return 0
+        if self.remaining <= 0:
+            # Exhausted, wait for the window to reset
+            return window + 1
+        return window / (self.remaining + 1)
+
+    def wait(self) -> None:
+        delay = self.delay()
+        if delay > 0:
+            time.sleep(delay)
+
+def backfill(user: tweepy.User) -> None:
+    checkpoint = bowtiedb.read_config(BACKFILL_CHECKPOINT)
+    if checkpoint == BACKFILL_DONE:
+        logging.info("Backfill already complete")
+        return
+    max_id = int(checkpoint) if checkpoint else None
+    scheduler = RateLimitScheduler()
+    total = 0
+    while True:
+        scheduler.wait()
+        try:
+            timeline: List[tweepy.models.Status] = api.user_timeline(user_id=user.id, include_rts=True, tweet_mode='extended',
+                count=BACKFILL_PAGE_SIZE, max_id=max_id)
+        except tweepy.TooManyRequests as e:
+            scheduler.rejected(e.response.headers)
             continue
-        # print("status %s", status)
-        created_at: datetime.datetime = status.created_at
-        created_at_unixtime = int(time.mktime(created_at.timetuple()))
-        text:Text = status.full_text
-        if status.display_text_range:
-            text = text[status.display_text_range[0]:status.display_text_range[1]]
-        author:tweepy.models.User = status.author
-        author_name = author.screen_name
-        profile_image:Optional[Text] = None
-        if hasattr(author, 'profile_image_url'):
-            profile_image = author.profile_image_url
-            profile_image = profile_image.replace("_normal", "")
-        photo_url = None
-        if hasattr(status, 'extended_entities'):
-            extended_entities:dict = status.extended_entities
-            if extended_entities and extended_entities["media"] and len(extended_entities["media"]) > 0 and extended_entities["media"][0]["media_url"]:
-                photo_url = extended_entities["media"][0]["media_url"]
-        # TODO save tweet json
-        download_profile_image = None
-        if profile_image:
-            download_profile_image = profile_image.replace("http://pbs.twimg.com/", "").replace("/", "_")
-            if not os.path.exists(downloads_path + "/" + download_profile_image):
-                with urllib.request.urlopen(profile_image) as f:
-                    with open(downloads_path + "/" + download_profile_image, 'wb') as fh:
-                        fh.write(f.read())
-                        logging.info("Wrote %s", download_profile_image)
-        download_photo_url = None
-        if photo_url:
-            download_photo_url = photo_url.replace("http://pbs.twimg.com/", "").replace("/", "_")
-            if not os.path.exists(downloads_path + "/" + download_photo_url):
-                with urllib.request.urlopen(photo_url) as f:
-                    with open(downloads_path + "/" + download_photo_url, 'wb') as fh:
-                        fh.write(f.read())
-                        logging.info("Wrote %s", download_photo_url)
-        bowtiedb.save_tweet(status.id, json.dumps(status._json))
-        bowtiedb.add_entry(bowtiedb.Entry(created_at_unixtime, text, download_photo_url, [], author_name, download_profile_image))
-        print(author_name, download_profile_image, created_at_unixtime, text, download_photo_url)
+        scheduler.accepted(api.last_response.headers)
+        if not timeline:
+            bowtiedb.set_config(BACKFILL_CHECKPOINT, BACKFILL_DONE)
+            logging.info("Backfill complete, added %d tweets", total)
+            return
+        total += handleTimeline(timeline)
+        # Saved once the page is committed, a crash in between only repeats
+        # this page and its tweets are skipped as already known
+        max_id = min([status.id for status in timeline]) - 1
+        bowtiedb.set_config(BACKFILL_CHECKPOINT, str(max_id))
+        logging.info("Backfilled %d tweets, continuing before %d", total, max_id)
+
+def poll(user: tweepy.User) -> None:
+    timeline: List[tweepy.models.Status] = api.user_timeline(user_id=user.id, include_rts=True, tweet_mode='extended', count=10)
+    handleTimeline(timeline)
+
 def main() -> None:
     bowtiedb.init()
     try:
@@ -88,13 +251,16 @@ def main() -> None:
     # print("%s",api.home_timeline())
     print("User id %s", user.id)
 
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        backfill(user)
+        return
+
     while True:
         try:
-            timeline: List[tweepy.models.Status] = api.user_timeline(user_id=user.id, include_rts=True, tweet_mode='extended', count=10)
-            handleTimeline(timeline)
+            poll(user)
         except Exception as e:
             logging.error("An error!", e)
-        time.sleep(60)
+        time.sleep(POLL_INTERVAL)
 
 if __name__ == '__main__':
     main()
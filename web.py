@@ -0,0 +1,172 @@
+import os
+import html
+import re
+import hashlib
+import threading
+import time
+import logging
+import datetime
+import functools
+import urllib.parse
+from typing import Dict, List, Optional, Text, Tuple
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+import bowtiedb
+import gen
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+load_dotenv()
+
+web_path = os.environ["WEB_PATH"]
+port = int(os.getenv("PORT", "8889"))
+SEARCH_PAGE_SIZE = 10
+# Variants are named after a hash of their content and encoding, a name
+# never refers to different bytes so browsers may keep them forever
+IMMUTABLE_NAME = re.compile(r"[0-9a-f]{24}\.(jpg|gif)")
+
+class EtagCache():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.etags: Dict[Text, Tuple[Tuple[int, int], Text]] = dict()
+
+    def etag(self, path: Text) -> Optional[Text]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.etags.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        # Strong validator: derived from the bytes, not just the mtime
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(65536), b""):
+                digest.update(chunk)
+        etag = '"' + digest.hexdigest()[:32] + '"'
+        with self.lock:
+            self.etags[path] = (key, etag)
+        return etag
+
+etag_cache = EtagCache()
+
+def makeSnippetHtml(snippet: Text) -> Text:
+    output = html.escape(snippet)
+    output = output.replace(bowtiedb.SNIPPET_BEGIN, '<b><font color="#deb836">')
+    output = output.replace(bowtiedb.SNIPPET_END, '</font></b>')
+    return output.replace("\n", "<br>\n")
+
+def makeSearchHtml(query: Text, page: int, results: List[bowtiedb.SearchResult], has_more: bool) -> Text:
+    search_form = gen.SEARCH_FORM.replace('value=""', 'value="' + html.escape(query) + '"')
+    page_html = gen.TEMPLATE_BEGIN.replace(gen.SEARCH_FORM, search_form)
+    page_html += gen.NAV_BEGIN
+    page_html += '<td align="left"><a href="index.html"><font color="#f7b2a9">First Page</font></a></td>'
+    page_html += gen.NAV_END
+    page_html += gen.ENTRIES_BEGIN
+    if not results:
+        page_html += '<tr><td><font color="#f6f3ed">No results</font></td></tr>\n'
+    for result in results:
+        entry = result.entry
+        display_name = entry.display_name or 'Null'
+        page_html += '<tr><td><font color="#deb836"><b>' + html.escape(display_name) + '</b></font></td>'
+        page_html += '<td><font color="#f6f3ed"><i>' + str(datetime.datetime.fromtimestamp(entry.date)) + ' UTC</i></font></td></tr>\n'
+        page_html += '<tr><td colspan="2"><font color="#f6f3ed">' + makeSnippetHtml(result.snippet) + '</font></td></tr>\n'
+    page_html += gen.ENTRIES_END
+    page_html += gen.NAV_BEGIN
+    page_html += '<td align="left">'
+    if page > 0:
+        page_html += '<a href="search?' + urllib.parse.urlencode({"q": query, "page": page - 1}) + '"><font color="#f7b2a9">Previous Results</font></a>'
+    page_html += '</td><td align="right">'
+    if has_more:
+        page_html += '<a href="search?' + urllib.parse.urlencode({"q": query, "page": page + 1}) + '"><font color="#f7b2a9">More Results</font></a>'
+    page_html += '</td>' + gen.NAV_END
+    page_html += gen.TEMPLATE_END
+    return page_html
+
+class BowtieRequestHandler(SimpleHTTPRequestHandler):
+    etag: Optional[Text] = None
+    immutable = False
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/search":
+            self.sendSearch(url.query)
+        elif not self.sendNotModified():
+            super().do_GET()
+
+    def do_HEAD(self) -> None:
+        if not self.sendNotModified():
+            super().do_HEAD()
+
+    def end_headers(self) -> None:
+        if self.etag:
+            self.send_header("ETag", self.etag)
+        if self.immutable:
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        super().end_headers()
+
+    def sendNotModified(self) -> bool:
+        self.etag = None
+        self.immutable = False
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # Served as its index page when the url ends with a slash, the
+            # same way send_head picks it
+            if not urllib.parse.urlsplit(self.path).path.endswith("/"):
+                return False
+            for index in ("index.html", "index.htm"):
+                if os.path.isfile(os.path.join(path, index)):
+                    path = os.path.join(path, index)
+                    break
+            else:
+                return False
+        self.etag = etag_cache.etag(path)
+        if not self.etag:
+            return False
+        self.immutable = IMMUTABLE_NAME.fullmatch(os.path.basename(path)) is not None
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            if self.etag in tags or "*" in tags:
+                self.send_response(304)
+                self.end_headers()
+                return True
+            # If-None-Match takes precedence over If-Modified-Since
+            del self.headers["If-Modified-Since"]
+        return False
+
+    def sendSearch(self, query_string: Text) -> None:
+        params = urllib.parse.parse_qs(query_string)
+        query = params.get("q", [""])[0][:200]
+        try:
+            page = max(int(params.get("page", ["0"])[0]), 0)
+        except ValueError:
+            page = 0
+        start = time.perf_counter()
+        # Ask for one extra result to learn if there is another page
+        results = bowtiedb.search_entries(query, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE)
+        logging.info("Search %r page %d took %.1fms", query, page, (time.perf_counter() - start) * 1000)
+        has_more = len(results) > SEARCH_PAGE_SIZE
+        body = makeSearchHtml(query, page, results[:SEARCH_PAGE_SIZE], has_more).encode("iso-8859-1", 'ignore')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=iso-8859-1")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def createServer() -> ThreadingHTTPServer:
+    handler = functools.partial(BowtieRequestHandler, directory=web_path)
+    return ThreadingHTTPServer(("", port), handler)
+
+def main() -> None:
+    bowtiedb.init()
+    server = createServer()
+    logging.info("Serving %s on port %d", web_path, port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()